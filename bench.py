@@ -0,0 +1,553 @@
+# -*- coding: utf8 -*-
+
+# rough benchmarks for sh's internals.  these aren't tests, they just print
+# numbers.  run "python bench.py" for all of them, or "python bench.py <name>"
+# for just the ones you care about
+
+import os
+import sys
+import time
+import threading
+import resource
+import sh
+
+
+benchmarks = []
+
+def benchmark(fn):
+    benchmarks.append(fn)
+    return fn
+
+
+def report(name, value, unit):
+    print("  %-45s %12.3f %s" % (name, value, unit))
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY: hard = 65536
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+
+@benchmark
+def concurrent_children():
+    """ how the io scales with lots of background processes running at
+    once """
+    limit = raise_fd_limit()
+
+    for n in (10, 100, 1000):
+        # each child costs us a few fds
+        if n * 4 > limit: break
+
+        started = time.time()
+        procs = [sh.sleep(0.5, _bg=True, _tty_out=False) for i in range(n)]
+        spawned = time.time() - started
+        threads = threading.active_count()
+
+        for p in procs: p.wait()
+        elapsed = time.time() - started
+
+        report("%d children: spawn" % n, spawned, "s")
+        report("%d children: threads while running" % n, threads, "")
+        report("%d children: total (0.5s of sleep)" % n, elapsed, "s")
+
+
+
+@benchmark
+def spawn_vs_fork():
+    """ commands per second through posix_spawn and through fork, as the
+    parent's memory grows """
+    if not hasattr(os, "posix_spawn"):
+        print("  posix_spawn isn't available, skipping")
+        return
+
+    ballast = []
+    n = 200
+    for rss_mb in (0, 256, 1024):
+        # touch every page, so that it really is resident
+        while len(ballast) < rss_mb:
+            ballast.append(bytearray(1024 ** 2))
+
+        for use_spawn in (True, False):
+            sh.OProc._use_posix_spawn = use_spawn
+            started = time.time()
+            for i in range(n): sh.true(_tty_out=False)
+            elapsed = time.time() - started
+
+            how = use_spawn and "posix_spawn" or "fork"
+            report("%dMB parent, %s" % (rss_mb, how), n / elapsed, "cmds/s")
+
+    sh.OProc._use_posix_spawn = True
+
+
+
+@benchmark
+def fd_closing():
+    """ the cost of closing fds in the child before exec, with a high
+    RLIMIT_NOFILE, on the fork path """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    for limit in (1024 ** 2, hard):
+        try: resource.setrlimit(resource.RLIMIT_NOFILE, (limit, limit))
+        except (ValueError, OSError): continue
+        break
+
+    def close_everything(pass_fds, close_range):
+        os.closerange(3, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+
+    real_close_fds = sh._close_fds
+    close_range = sh._get_close_range()
+
+    n = 50
+    strategies = (
+        ("close_range", real_close_fds, close_range),
+        ("/proc/self/fd", real_close_fds, False),
+        ("closerange up to the rlimit", close_everything, False),
+    )
+    for name, close_fds, close_range in strategies:
+        if name == "close_range" and not close_range: continue
+
+        sh._close_fds = close_fds
+        sh._libc_close_range = close_range
+        started = time.time()
+        for i in range(n): sh.true()
+        elapsed = time.time() - started
+        report("RLIMIT_NOFILE %d, %s" % (limit, name), elapsed / n * 1000,
+            "ms/cmd")
+
+    sh._close_fds = real_close_fds
+    sh._libc_close_range = None
+
+
+
+@benchmark
+def pipeline_throughput():
+    """ how fast data moves between two composed commands """
+    n = 32 * 1024 ** 2
+    modes = (
+        ("through python", dict(_piped=True, _tty_out=False,
+            _out_bufsize=64 * 1024)),
+        ("direct", dict(_piped="direct")),
+    )
+    for name, kwargs in modes:
+        started = time.time()
+        sh.wc(sh.head("-c", n, "/dev/zero", **kwargs), "-c")
+        elapsed = time.time() - started
+        report("%dMB, %s" % (n // 1024 ** 2, name), n / elapsed / 1024 ** 2,
+            "MB/s")
+
+    started = time.time()
+    sh.sh("-c", "head -c %d /dev/zero | wc -c" % n)
+    elapsed = time.time() - started
+    report("%dMB, shell pipeline" % (n // 1024 ** 2), n / elapsed / 1024 ** 2,
+        "MB/s")
+
+
+
+@benchmark
+def file_redirection():
+    """ how fast output gets to a file through python, and when the process
+    writes it there itself """
+    import tempfile
+
+    n = 64 * 1024 ** 2
+    modes = (
+        ("through python", dict(_tee=True, _no_out=True)),
+        ("direct", dict()),
+    )
+    for name, kwargs in modes:
+        out = tempfile.TemporaryFile()
+        started = time.time()
+        sh.head("-c", n, "/dev/zero", _out=out, _tty_out=False,
+            _out_bufsize=64 * 1024, **kwargs)
+        elapsed = time.time() - started
+        out.close()
+        report("%dMB, %s" % (n // 1024 ** 2, name), n / elapsed / 1024 ** 2,
+            "MB/s")
+
+
+
+@benchmark
+def capture_memory():
+    """ how much memory a million captured lines take up """
+    import tracemalloc
+    from collections import deque
+
+    buffers = (
+        ("deque of chunks", deque(maxlen=3 * 1024 ** 2)),
+        ("CaptureBuffer", sh.CaptureBuffer(maxchunks=3 * 1024 ** 2)),
+    )
+    for name, buf in buffers:
+        tracemalloc.start()
+        for i in range(1000000): buf.append(("%07d\n" % i).encode())
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report(name, size / 1024.0 ** 2, "MB")
+
+
+
+@benchmark
+def repeated_access():
+    """ looking at a big finished command's output over and over """
+    n = 64 * 1024 ** 2
+    p = sh.head("-c", n, "/dev/zero", _tty_out=False, _out_bufsize=64 * 1024,
+        _no_pipe=True)
+    p.wait()
+
+    patterns = (
+        (".stdout", lambda: p.stdout),
+        ("str()", lambda: str(p)),
+        ("len()", lambda: len(p)),
+        ("\"x\" in", lambda: "x" in p),
+        (".startswith()", lambda: p.startswith("x")),
+    )
+    for name, fn in patterns:
+        started = time.time()
+        for i in range(10): fn()
+        report("%dMB, 10x %s" % (n // 1024 ** 2, name),
+            (time.time() - started) * 1000, "ms")
+
+
+
+@benchmark
+def iteration_wakeups():
+    """ what iterating over a quiet command costs us, and how long it takes
+    for a line to get to us once the command writes it """
+    def cpu():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    # one iteration over a command that doesn't write anything for a second
+    p = sh.sh("-c", "sleep 1; echo", _iter=True, _tty_out=False)
+    started = cpu()
+    for line in p: pass
+    report("idle iteration, cpu per second", cpu() - started, "s")
+
+    script = "import sys, time\n" \
+        "for i in range(50):\n" \
+        "    time.sleep(0.02)\n" \
+        "    sys.stdout.write('%r\\n' % time.time())\n" \
+        "    sys.stdout.flush()\n"
+    latencies = []
+    for line in sh.Command(sys.executable)("-c", script, _iter=True,
+            _tty_out=False):
+        latencies.append(time.time() - float(line))
+    latencies.sort()
+    report("first line latency, median", latencies[len(latencies) // 2] * 1e6,
+        "us")
+    report("first line latency, max", latencies[-1] * 1e6, "us")
+
+
+
+@benchmark
+def batch_iteration():
+    """ lines per second through _iter, one at a time and in batches """
+    n = 500000
+    modes = (
+        ("_iter=True", dict(_iter=True)),
+        ("_iter_batch=(10000, 0.05)", dict(_iter_batch=(10000, 0.05))),
+    )
+    for name, kwargs in modes:
+        started = time.time()
+        lines = 0
+        for item in sh.seq(n, _tty_out=False, **kwargs):
+            if isinstance(item, list): lines += len(item)
+            else: lines += 1
+        elapsed = time.time() - started
+        report("%d lines, %s" % (lines, name), lines / elapsed, "lines/s")
+
+
+
+@benchmark
+def line_buffering():
+    """ how fast the bufferer chops up output into lines, the way a reader
+    gets it: 1024 byte reads """
+    line = "line %d of the output, with some %s\n"
+    texts = (
+        ("ascii", "".join(line % (i, "ascii") for i in range(50000))),
+        ("utf8", "".join(line % (i, "ünïcödé") for i in range(50000))),
+    )
+    modes = (("line buffered", 1), ("unbuffered", 0), ("4096 buffered", 4096))
+
+    for text_name, text in texts:
+        text = text.encode("utf8")
+        reads = [text[i:i + 1024] for i in range(0, len(text), 1024)]
+
+        for name, bufsize in modes:
+            bufferer = sh.StreamBufferer("utf8", bufsize)
+            started = time.time()
+            for read in reads: bufferer.process(read)
+            elapsed = time.time() - started
+            report("%s, %s" % (text_name, name), len(reads) / elapsed,
+                "chunks/s")
+
+
+
+@benchmark
+def read_throughput():
+    """ how fast we read a command's output that nobody looks at, through a
+    tty and through plain pipes, with a bigger pipe, and with _binary """
+    n = 256 * 1024 ** 2
+    script = "yes 0123456789abcdefghijklmnopqrstuvwxyz | head -c %d" % n
+    modes = (
+        ("tty", dict()),
+        ("pipe", dict(_tty_out=False)),
+        ("pipe, _pipe_size=1MB", dict(_tty_out=False, _pipe_size=1024 ** 2)),
+        ("_binary", dict(_binary=True)),
+        ("_binary, _pipe_size=1MB", dict(_binary=True, _pipe_size=1024 ** 2)),
+    )
+    for name, kwargs in modes:
+        if "_pipe_size" in kwargs and "pipe_size" not in sh.Command._call_args:
+            continue
+        started = time.time()
+        sh.sh("-c", script, _no_out=True, _no_pipe=True, **kwargs)
+        report("%dMB, %s" % (n // 1024 ** 2, name),
+            n / (time.time() - started) / 1024 ** 2, "MB/s")
+
+
+
+@benchmark
+def stdin_throughput():
+    """ how fast we feed a process's stdin from a string, and from a
+    generator that needs an input thread """
+    n = 64 * 1024 ** 2
+    data = "x" * n
+    chunk = "x" * (64 * 1024)
+
+    def gen():
+        for i in range(n // len(chunk)): yield chunk
+
+    modes = (
+        ("string", lambda: data),
+        ("generator", gen),
+    )
+    for name, stdin in modes:
+        started = time.time()
+        sh.cat(_in=stdin(), _in_bufsize=64 * 1024, _tty_out=False,
+            _no_out=True, _no_pipe=True)
+        report("%dMB, %s" % (n // 1024 ** 2, name),
+            n / (time.time() - started) / 1024 ** 2, "MB/s")
+
+
+
+@benchmark
+def small_stdin_writes():
+    """ feeding stdin unbuffered from a string, and from a generator of small
+    items """
+    n = 4 * 1024 ** 2
+    data = "x" * n
+    line = "%07d\n"
+
+    def gen():
+        for i in range(n // 8): yield line % i
+
+    modes = (
+        ("string", lambda: data),
+        ("generator of lines", gen),
+        ("list of lines", lambda: list(gen())),
+    )
+    for name, stdin in modes:
+        stdin = stdin()
+        started = time.time()
+        sh.cat(_in=stdin, _tty_out=False, _no_out=True, _no_pipe=True)
+        report("%dMB, %s" % (n // 1024 ** 2, name),
+            n / (time.time() - started) / 1024 ** 2, "MB/s")
+
+
+
+@benchmark
+def queue_handoff():
+    """ how long it takes for something put on a process's stdin queue to
+    come back out of it """
+    try: from Queue import Queue
+    except ImportError: from queue import Queue
+
+    q = Queue()
+    p = sh.cat(_in=q, _iter=True, _tty_out=False)
+    latencies = []
+    for i in range(200):
+        time.sleep(0.002)
+        started = time.time()
+        q.put("%d\n" % i)
+        next(p)
+        latencies.append(time.time() - started)
+    q.put(None)
+    p.wait()
+
+    latencies.sort()
+    report("round trip, median", latencies[len(latencies) // 2] * 1e6, "us")
+    report("round trip, max", latencies[-1] * 1e6, "us")
+
+
+
+@benchmark
+def pipe_backpressure():
+    """ the most output that piles up in python between a fast command and
+    a slower one that it's piped into, with and without a bound on it """
+    slow_reader = ("import sys, time\n"
+        "while sys.stdin.buffer.read(64 * 1024): time.sleep(0.001)\n")
+
+    n = 64 * 1024 ** 2
+    bounds = (
+        ("unbounded", sys.maxsize),
+        ("default bound", None),
+    )
+    for name, maxbytes in bounds:
+        p = sh.head("-c", n, "/dev/zero", _piped=True, _tty_out=False,
+            _out_bufsize=64 * 1024, _out_maxbytes=0, _pipe_maxbytes=maxbytes)
+        queue = p.process._pipe_queue
+        peak = [0]
+        done = threading.Event()
+
+        def sample():
+            while not done.is_set():
+                peak[0] = max(peak[0], queue.nbytes)
+                time.sleep(0.005)
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+
+        started = time.time()
+        sh.python(p, "-c", slow_reader)
+        elapsed = time.time() - started
+        done.set()
+        sampler.join()
+        report("%dMB, %s, peak queued" % (n // 1024 ** 2, name),
+            peak[0] / 1024.0 ** 2, "MB")
+        report("%dMB, %s" % (n // 1024 ** 2, name), n / elapsed / 1024 ** 2,
+            "MB/s")
+
+
+
+@benchmark
+def capture_without_pipe():
+    """ how much memory a command's output takes up when it's only captured,
+    and when something has subscribed to its pipe queue from the start """
+    import tracemalloc
+
+    n = 64 * 1024 ** 2
+    for name, subscribe in (("captured", False), ("captured and piped", True)):
+        tracemalloc.start()
+        p = sh.head("-c", n, "/dev/zero", _tty_out=False, _bg=True)
+        if subscribe: p.process._subscribe_pipe()
+        p.wait()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report("%dMB, %s" % (n // 1024 ** 2, name), size / 1024.0 ** 2, "MB")
+        del p
+
+
+
+@benchmark
+def binary_output():
+    """ random bytes through a callback and through iteration, trial-decoded
+    and with _binary """
+    n = 16 * 1024 ** 2
+    modes = (("default", dict()), ("_binary=True", dict(_binary=True)))
+
+    for name, kwargs in modes:
+        started = time.time()
+        sh.head("-c", n, "/dev/urandom", _out=lambda chunk: None,
+            _tty_out=False, **kwargs).wait()
+        report("%dMB callback, %s" % (n // 1024 ** 2, name),
+            n / (time.time() - started) / 1024 ** 2, "MB/s")
+
+    for name, kwargs in modes:
+        started = time.time()
+        for chunk in sh.head("-c", n, "/dev/urandom", _iter=True,
+            _tty_out=False, **kwargs): pass
+        report("%dMB _iter, %s" % (n // 1024 ** 2, name),
+            n / (time.time() - started) / 1024 ** 2, "MB/s")
+
+
+
+@benchmark
+def callback_dispatch():
+    """ lines per second through an _out callback, one at a time, in
+    batches, and on an executor """
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(2)
+
+    n = 500000
+    modes = (
+        ("per line", dict()),
+        ("_callback_batch", dict(_callback_batch=True)),
+        ("per line, executor", dict(_callback_executor=executor)),
+        ("_callback_batch, executor", dict(_callback_batch=True,
+            _callback_executor=executor)),
+    )
+    for name, kwargs in modes:
+        def count(data): pass
+        started = time.time()
+        sh.seq(n, _out=count, _tty_out=False, **kwargs).wait()
+        report("%d lines, %s" % (n, name), n / (time.time() - started),
+            "lines/s")
+    executor.shutdown()
+
+
+
+@benchmark
+def parallel_jobs():
+    """ commands per second through parallel(), for commands that mostly
+    wait, and for ones that do next to nothing """
+    n = 64
+    for jobs in (1, 8, 32):
+        started = time.time()
+        for result in sh.parallel(sh.sleep, ["0.05"] * n, jobs=jobs): pass
+        report("%d x sleep 0.05, %d jobs" % (n, jobs),
+            n / (time.time() - started), "cmds/s")
+
+    n = 500
+    for jobs in (1, 8):
+        started = time.time()
+        for result in sh.parallel(sh.true, [()] * n, jobs=jobs): pass
+        report("%d x true, %d jobs" % (n, jobs),
+            n / (time.time() - started), "cmds/s")
+
+
+
+@benchmark
+def call_overhead():
+    """ the python side of calling a baked command, without running
+    anything """
+    class NotRunning(object):
+        def __init__(self, cmd, call_args, stdin, stdout, stderr): pass
+
+    real_running_command = sh.RunningCommand
+    echo = sh.echo.bake("-n", _tty_out=False)
+
+    n = 100000
+    sh.RunningCommand = NotRunning
+    try:
+        started = time.time()
+        for i in range(n): echo()
+        report("baked command, no args", (time.time() - started) / n * 1e6,
+            "us/call")
+
+        started = time.time()
+        for i in range(n): echo("hello", "world", _err_to_out=True)
+        report("baked command, args and special kwargs",
+            (time.time() - started) / n * 1e6, "us/call")
+    finally:
+        sh.RunningCommand = real_running_command
+
+    # a _with command sets itself up without starting a process
+    call_args = sh.Command._call_args.copy()
+    call_args["with"] = True
+    cmd = [b"/bin/echo", b"hello"]
+
+    started = time.time()
+    for i in range(n):
+        sh.RunningCommand(cmd, call_args, None, None, None)
+        sh.Command._prepend_stack.pop()
+    report("RunningCommand setup", (time.time() - started) / n * 1e6,
+        "us/call")
+
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    for fn in benchmarks:
+        if names and fn.__name__ not in names: continue
+        print(fn.__name__)
+        fn()
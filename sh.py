@@ -50,6 +50,17 @@ import time as _time
 from locale import getpreferredencoding
 DEFAULT_ENCODING = getpreferredencoding() or "utf-8"
 
+# how much we read from a process's output at a time with _binary
+BINARY_READ_SIZE = 64 * 1024
+
+# reads of a process's output get bigger while they keep coming back full, up
+# to this
+MAX_READ_SIZE = 1024 ** 2
+
+# the most output that we let pile up on a pipe queue by default, when another
+# command or an "async for" is reading from it, before we stop reading more
+PIPE_MAXBYTES = 4 * 1024 ** 2
+
 
 if IS_PY3:
     from io import StringIO
@@ -79,8 +90,14 @@ import fcntl
 import struct
 import resource
 from collections import deque
+from array import array
+import heapq
 import logging
 import weakref
+import codecs
+import mmap
+# there's a tempfile program, which sh.tempfile should find
+import tempfile as _tempfile
 
 
 logging_enabled = False
@@ -91,6 +108,15 @@ if IS_PY3:
     unicode = str
     basestring = str
 
+# python 2.6 doesn't have memoryview, so there, what we'd have sliced a view
+# of without copying it gets sliced, and copied, itself
+try:
+    _view = memoryview
+    _bytes_types = (bytes, bytearray, memoryview)
+except NameError:
+    _view = lambda data: data
+    _bytes_types = (bytes, bytearray)
+
 
 def encode_to_py3bytes_or_py2str(s):
     """ takes anything and attempts to return a py2 string or py3 bytes.  this
@@ -155,6 +181,16 @@ class ErrorReturnCode(Exception):
 
 class SignalException(ErrorReturnCode): pass
 
+# raised by RunningCommand.wait() when it's given a timeout and the process is
+# still running after that long.  the process is left running
+class TimeoutException(Exception):
+    def __init__(self, full_cmd, timeout):
+        self.full_cmd = full_cmd
+        self.timeout = timeout
+        msg = "\n\n  RAN: %r\n\n  still running after %r seconds" % \
+            (full_cmd, timeout)
+        super(TimeoutException, self).__init__(msg)
+
 SIGNALS_THAT_SHOULD_THROW_EXCEPTION = (
     signal.SIGKILL,
     signal.SIGSEGV,
@@ -190,6 +226,23 @@ def get_rc_exc(rc):
 
 
 
+# which() gets called for every sh.<program> lookup, so we remember what it
+# finds, and what it doesn't find.  entries are keyed on the program and the
+# value of $PATH, and they're only trusted as long as the directories that they
+# depend on haven't been modified, since adding or removing a program changes
+# the mtime of the directory it's in.  a program found in the 3rd PATH
+# directory depends on the first 3 directories, and a program that wasn't
+# found depends on all of them.  making a file executable doesn't change its
+# directory though, so we don't cache a lookup that passed over a file that
+# wasn't, and a found program has to still be executable
+_which_cache = {}
+_which_cache_stats = {"hits": 0, "misses": 0}
+
+def _dir_mtime(path):
+    try: return os.stat(path).st_mtime
+    except OSError: return None
+
+
 def which(program):
     def is_exe(fpath):
         return os.path.exists(fpath) and os.access(fpath, os.X_OK)
@@ -197,14 +250,56 @@ def which(program):
     fpath, fname = os.path.split(program)
     if fpath:
         if is_exe(program): return program
-    else:
-        if "PATH" not in os.environ: return None
-        for path in os.environ["PATH"].split(os.pathsep):
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
+        return None
+
+    if "PATH" not in os.environ: return None
+    path_env = os.environ["PATH"]
+
+    key = (program, path_env)
+    entry = _which_cache.get(key)
+    if entry is not None:
+        exe_file, dir_mtimes = entry
+        fresh = all(_dir_mtime(path) == mtime for path, mtime in dir_mtimes)
+        if fresh and (exe_file is None or is_exe(exe_file)):
+            _which_cache_stats["hits"] += 1
+            return exe_file
+    _which_cache_stats["misses"] += 1
+
+    found = None
+    dir_mtimes = []
 
-    return None
+    # relative PATH directories depend on our cwd, which we don't track
+    cacheable = True
+
+    for path in path_env.split(os.pathsep):
+        if not os.path.isabs(path): cacheable = False
+
+        # we get the mtime before we look, so that if the directory changes
+        # while we're looking, the entry is already stale
+        dir_mtimes.append((path, _dir_mtime(path)))
+        exe_file = os.path.join(path, program)
+        if is_exe(exe_file):
+            found = exe_file
+            break
+        if os.path.exists(exe_file): cacheable = False
+
+    if cacheable: _which_cache[key] = (found, dir_mtimes)
+    return found
+
+
+def _which_cache_info():
+    """ returns which()'s cache hits, misses, and number of entries """
+    info = _which_cache_stats.copy()
+    info["size"] = len(_which_cache)
+    return info
+
+def _which_cache_clear():
+    _which_cache.clear()
+    _which_cache_stats["hits"] = 0
+    _which_cache_stats["misses"] = 0
+
+which.cache_info = _which_cache_info
+which.cache_clear = _which_cache_clear
 
 def resolve_program(program):
     path = which(program)
@@ -231,11 +326,30 @@ def glob(arg):
 
 
 class Logger(object):
+    """ context can be a string, or a callable returning one.  building the
+    context can be expensive (it's usually a repr of a command line), and it's
+    only needed if we actually log something, so a callable is only called
+    the first time it's needed """
+
     def __init__(self, name, context=None):
         self.name = name
-        self.context = "%s"
-        if context: self.context = "%s: %%s" % context
-        self.log = logging.getLogger(name)
+        self._context = context
+        self._context_fmt = None
+        self._log = None
+
+    @property
+    def log(self):
+        if self._log is None: self._log = logging.getLogger(self.name)
+        return self._log
+
+    @property
+    def context(self):
+        if self._context_fmt is None:
+            context = self._context
+            if callable(context): context = context()
+            if context: self._context_fmt = "%s: %%s" % context
+            else: self._context_fmt = "%s"
+        return self._context_fmt
 
     def info(self, msg, *args):
         if not logging_enabled: return
@@ -257,24 +371,12 @@ class Logger(object):
 
 class RunningCommand(object):
     def __init__(self, cmd, call_args, stdin, stdout, stderr):
-        truncate = 20
-        if len(cmd) > truncate:
-            logger_str = "command %r...(%d more) call_args %r" % \
-                (cmd[:truncate], len(cmd) - truncate, call_args)
-        else:
-            logger_str = "command %r call_args %r" % (cmd, call_args)
-
-        self.log = Logger("command", logger_str)
+        self.log = Logger("command", self._logger_str)
         self.call_args = call_args
         self.cmd = cmd
-
-        # self.ran is used for auditing what actually ran.  for example, in
-        # exceptions, or if you just want to know what was ran after the
-        # command ran
-        if IS_PY3:
-            self.ran = " ".join([arg.decode(DEFAULT_ENCODING, "ignore") for arg in cmd])
-        else:
-            self.ran = " ".join(cmd)
+        self._ran = None
+        self._unicode = None
+        self._str = None
 
         self.process = None
 
@@ -299,9 +401,19 @@ class RunningCommand(object):
         if callable(call_args["out"]) or callable(call_args["err"]):
             self.should_wait = False
 
+        # batched iteration is iteration, just more than a chunk at a time
+        self._batch_size = None
+        self._batch_done = False
+        if call_args["iter_batch"]:
+            self._batch_size = self._parse_batch_size(call_args["iter_batch"])
+            if not call_args["iter"]: call_args["iter"] = True
+
         if call_args["piped"] or call_args["iter"] or call_args["iter_noblock"]:
             self.should_wait = False
 
+        # with asyncio, the caller awaits us instead
+        if call_args["async"]: self.should_wait = False
+
         # we're running in the background, return self and let us lazily
         # evaluate
         if call_args["bg"]: self.should_wait = False
@@ -311,8 +423,6 @@ class RunningCommand(object):
 
 
         # set up which stream should write to the pipe
-        # TODO, make pipe None by default and limit the size of the Queue
-        # in oproc.OProc
         pipe = STDOUT
         if call_args["iter"] == "out" or call_args["iter"] is True: pipe = STDOUT
         elif call_args["iter"] == "err": pipe = STDERR
@@ -330,8 +440,44 @@ class RunningCommand(object):
                 self.wait()
 
 
-    def wait(self):
-        self._handle_exit_code(self.process.wait())
+    @staticmethod
+    def _parse_batch_size(iter_batch):
+        """ _iter_batch is True, a maximum number of chunks per batch, or a
+        tuple of that and how long to wait for a batch to fill up """
+        if iter_batch is True: return (10000, 0.05)
+        if isinstance(iter_batch, (tuple, list)):
+            max_chunks, latency = iter_batch
+            return (int(max_chunks), float(latency))
+        return (int(iter_batch), 0)
+
+
+    def _logger_str(self):
+        truncate = 20
+        cmd = self.cmd
+        if len(cmd) > truncate:
+            return "command %r...(%d more) call_args %r" % \
+                (cmd[:truncate], len(cmd) - truncate, self.call_args)
+        return "command %r call_args %r" % (cmd, self.call_args)
+
+    # ran is used for auditing what actually ran.  for example, in
+    # exceptions, or if you just want to know what was ran after the
+    # command ran.  we only build it if somebody asks for it
+    @property
+    def ran(self):
+        if self._ran is None:
+            if IS_PY3:
+                self._ran = " ".join([arg.decode(DEFAULT_ENCODING, "ignore")
+                    for arg in self.cmd])
+            else:
+                self._ran = " ".join(self.cmd)
+        return self._ran
+
+
+    def wait(self, timeout=None):
+        exit_code = self.process.wait(timeout)
+        if exit_code is None: raise TimeoutException(self.ran, timeout)
+
+        self._handle_exit_code(exit_code)
         return self
 
     # here we determine if we had an exception, or an error code that we weren't
@@ -360,17 +506,34 @@ class RunningCommand(object):
         self.wait()
         return self.process.stderr
 
+    # these are the same as stdout and stderr, but as memoryviews, so that
+    # a lot of output doesn't get copied just to be looked at
+    @property
+    def stdout_view(self):
+        self.wait()
+        return self.process._stdout.getbuffer()
+
+    @property
+    def stderr_view(self):
+        self.wait()
+        return self.process._stderr.getbuffer()
+
     @property
     def exit_code(self):
         self.wait()
         return self.process.exit_code
 
+    @property
+    def rusage(self):
+        self.wait()
+        return self.process.rusage
+
     @property
     def pid(self):
         return self.process.pid
 
     def __len__(self):
-        return len(str(self))
+        return len(self._value())
 
     def __enter__(self):
         # we don't actually do anything here because anything that should
@@ -382,52 +545,169 @@ class RunningCommand(object):
     def __iter__(self):
         return self
 
+    # the longest we block on our pipe queue at a time, on python 2, where a
+    # get() without a timeout can't be interrupted by a KeyboardInterrupt.  on
+    # python 3 it can, so there we just wait until there's something for us
+    _pipe_get_timeout = None if IS_PY3 else 0.5
+
     def next(self):
-        # we do this because if get blocks, we can't catch a KeyboardInterrupt
-        # so the slight timeout allows for that.
-        while True:
-            try: chunk = self.process._pipe_queue.get(True, 0.001)
-            except Empty:
-                if self.call_args["iter_noblock"]: return errno.EWOULDBLOCK
-            else:
-                if chunk is None:
-                    self.wait()
-                    raise StopIteration()
-                try: return chunk.decode(self.call_args["encoding"],
-                    self.call_args["decode_errors"])
-                except UnicodeDecodeError: return chunk
+        if self._batch_size: return self._next_batch()
+        pipe_queue = self.process._subscribe_pipe()
+
+        if self.call_args["iter_noblock"]:
+            try: chunk = pipe_queue.get(False)
+            except Empty: return errno.EWOULDBLOCK
+        else:
+            while True:
+                try: chunk = pipe_queue.get(True, self._pipe_get_timeout)
+                except Empty: continue
+                break
+
+        if chunk is None:
+            self.wait()
+            raise StopIteration()
+        return self._decode_chunk(chunk)
 
     # python 3
     __next__ = next
 
+    # with _iter_batch, we give back a list of everything that's on our pipe
+    # queue, up to the most chunks we're allowed.  if there's less than that,
+    # we wait a little while, from when the first one showed up, for more
+    def _next_batch(self):
+        if self._batch_done:
+            self.wait()
+            raise StopIteration()
+
+        pipe_queue = self.process._subscribe_pipe()
+        max_chunks, latency = self._batch_size
+
+        while True:
+            try:
+                chunks = pipe_queue.get_batch(max_chunks,
+                    self._pipe_get_timeout)
+                break
+            except Empty: pass
+
+        deadline = _time.time() + latency
+        while len(chunks) < max_chunks and chunks[-1] is not None:
+            timeout = deadline - _time.time()
+            if timeout <= 0: break
+            try: chunks.extend(pipe_queue.get_batch(max_chunks - len(chunks),
+                timeout))
+            except Empty: break
+
+        # our output has ended.  this batch is the last one
+        if chunks[-1] is None:
+            chunks.pop()
+            self._batch_done = True
+            if not chunks: return self._next_batch()
+
+        return [self._decode_chunk(chunk) for chunk in chunks]
+
+    def _decode_chunk(self, chunk):
+        if self.call_args["binary"]: return chunk
+        try: return chunk.decode(self.call_args["encoding"],
+            self.call_args["decode_errors"])
+        except UnicodeDecodeError: return chunk
+
+
+    # asyncio support.  these are only usable with _async=True, where the
+    # process's io is done by the running event loop, and everything here
+    # happens in the loop's thread.  none of this uses the async/await syntax,
+    # so that we still compile on python 2
+
+    def __await__(self):
+        future = self.process._reactor.loop.create_future()
+
+        def done():
+            if future.cancelled(): return
+            try: future.set_result(self.wait())
+            except Exception as e: future.set_exception(e)
+
+        self.process.add_done_callback(done)
+        return future.__await__()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self.process._reactor.loop.create_future()
+        self.process._async_get(future, self._async_chunk)
+        return future
+
+    def _async_chunk(self, future, chunk):
+        if future.cancelled(): return
+
+        if chunk is not None:
+            future.set_result(self._decode_chunk(chunk))
+            return
+
+        def done():
+            if future.cancelled(): return
+            try: self.wait()
+            except Exception as e: future.set_exception(e)
+            else: future.set_exception(StopAsyncIteration())
+
+        self.process.add_done_callback(done)
+
     def __exit__(self, typ, value, traceback):
         if self.call_args["with"] and Command._prepend_stack:
             Command._prepend_stack.pop()
 
     def __str__(self):
         if IS_PY3: return self.__unicode__()
-        else: return unicode(self).encode(self.call_args["encoding"])
-
+        if not self.process: return ""
+        if self._str is None:
+            self._str = unicode(self).encode(self.call_args["encoding"])
+        return self._str
+
+    # len(), ==, "in", int() and every str method that we proxy in
+    # __getattr__ go through here, so we only decode our output once.  the
+    # process has finished by then, so it's not going to change
     def __unicode__(self):
-        if self.process and self.stdout:
-            return self.stdout.decode(self.call_args["encoding"],
-                self.call_args["decode_errors"])
-        return ""
+        if self._unicode is None:
+            if not self.process: return ""
+            # binary output is only ever decoded when someone explicitly asks
+            # us for text, and then it's not going to be valid text anyways
+            errors = self.call_args["decode_errors"]
+            if self.call_args["binary"]: errors = "replace"
+            self._unicode = self.stdout.decode(self.call_args["encoding"],
+                errors)
+        return self._unicode
+
+    def __bytes__(self):
+        return self.stdout
+
+    # what we look like to len(), ==, "in" and the rest.  with _binary, that's
+    # our raw output, so that none of those need to decode it
+    def _value(self):
+        if self.call_args["binary"]: return self.stdout
+        return unicode(self)
 
     def __eq__(self, other):
+        if self.call_args["binary"]:
+            if isinstance(other, RunningCommand): other = other._value()
+            return self.stdout == other
         return unicode(self) == unicode(other)
 
+    # python 3 takes away our __hash__ because we define __eq__.  we want to
+    # stay hashable, like we are on python 2, so that we can be used in sets
+    # and handed to things like asyncio.gather()
+    __hash__ = object.__hash__
+
     def __contains__(self, item):
-        return item in str(self)
+        return item in self._value()
 
     def __getattr__(self, p):
         # let these three attributes pass through to the OProc object
         if p in ("signal", "terminate", "kill"):
             if self.process: return getattr(self.process, p)
             else: raise AttributeError
-        return getattr(unicode(self), p)
+        return getattr(self._value(), p)
 
     def __repr__(self):
+        if self.call_args["binary"]: return repr(self.stdout)
         try: return str(self)
         except UnicodeDecodeError:
             if self.process:
@@ -435,13 +715,13 @@ class RunningCommand(object):
             return repr("")
 
     def __long__(self):
-        return long(str(self).strip())
+        return long(self._value().strip())
 
     def __float__(self):
-        return float(str(self).strip())
+        return float(self._value().strip())
 
     def __int__(self):
-        return int(str(self).strip())
+        return int(self._value().strip())
 
 
 
@@ -470,8 +750,8 @@ class Command(object):
 
         # this is how big the output buffers will be for stdout and stderr.
         # this is essentially how much output they will store from the process.
-        # we use a deque, so if it overflows past this amount, the first items
-        # get pushed off as each new item gets added.
+        # if it overflows past this amount, the first chunks get pushed off as
+        # each new chunk gets added.
         #
         # NOTICE
         # this is not a *BYTE* size, this is a *CHUNK* size...meaning, that if
@@ -479,13 +759,44 @@ class Command(object):
         # be "internal_bufsize" CHUNKS of 1024 bytes
         "internal_bufsize": 3 * 1024 ** 2,
 
+        # these are real *BYTE* limits on how much stdout and stderr we keep,
+        # on top of internal_bufsize.  None means no limit.  when we're over,
+        # maxbytes_drop says whether the "oldest" output gets pushed off, like
+        # with internal_bufsize, or whether the "newest" output doesn't get
+        # kept
+        "out_maxbytes": None,
+        "err_maxbytes": None,
+        "maxbytes_drop": "oldest",
+
+        # for output that's too big to keep in memory, but that we still want
+        # afterwards.  once there's more than this many bytes of stdout or
+        # stderr, all of it goes to an unlinked temporary file, which
+        # .stdout_view and .stderr_view mmap.  spilled output is all kept,
+        # internal_bufsize doesn't apply to it
+        "out_spill": None,
+        "err_spill": None,
+
         "env": None,
+
+        # True to run in the background, with our output going to whatever
+        # we're piped into.  "direct" does that through a kernel pipe that
+        # the other process reads from itself, without python seeing the
+        # data, so it isn't captured in .stdout
         "piped": None,
         "iter": None,
         "iter_noblock": None,
+
+        # iterate over lists of chunks instead of one chunk at a time.  this
+        # is True, the most chunks in a list, or a tuple of that and how long
+        # to wait for a list to fill up, like (10000, 0.05)
+        "iter_batch": None,
         "ok_code": 0,
         "cwd": None,
 
+        # file descriptors, besides stdin, stdout and stderr, that the process
+        # should inherit.  everything else is closed
+        "pass_fds": (),
+
         # the separator delimiting between a long-argument's name and its value
         # for example, --arg=derp, '=' is the long_sep
         "long_sep": "=",
@@ -498,9 +809,46 @@ class Command(object):
         "encoding": DEFAULT_ENCODING,
         "decode_errors": "strict",
 
+        # the output is binary, so never try to decode it.  callbacks,
+        # iteration and the rest all get bytes, and we read in big chunks,
+        # without looking for lines in them
+        "binary": False,
+
         # how long the process should run before it is auto-killed
         "timeout": 0,
 
+        # _out and _err callbacks get a list of all of the chunks that were
+        # read at once, instead of being called for every one of them
+        "callback_batch": False,
+
+        # a concurrent.futures executor to run _out and _err callbacks on,
+        # instead of on a thread of each stream's own.  a stream's callbacks
+        # are still run one at a time, in order
+        "callback_executor": None,
+
+        # the size, in bytes, of the kernel pipes that we make for the
+        # process's stdin, stdout and stderr, for commands that move a lot of
+        # data.  linux only, and capped by /proc/sys/fs/pipe-max-size
+        "pipe_size": None,
+
+        # the most bytes of our output that can be waiting on our pipe queue,
+        # to be iterated over or piped into another command, before we stop
+        # reading it from the process, which then blocks until whatever is
+        # reading from the queue catches up.  None means no limit, unless
+        # another command is piped from us, or we're iterated over with
+        # "async for", which get PIPE_MAXBYTES.  a command that's piped into
+        # another one also only keeps PIPE_MAXBYTES of its output in .stdout,
+        # as if it had been given that as _out_maxbytes, unless it was given
+        # _out_maxbytes or _out_spill itself.  unless it has a callback, or is
+        # being iterated over, its output isn't split into lines any more
+        # either, since a line with no end would be kept whole forever
+        "pipe_maxbytes": None,
+
+        # do the process's io on the running asyncio event loop.  the command
+        # returns immediately, and can be awaited, or iterated over with
+        # "async for" if _iter is also set
+        "async": False,
+
         # these control whether or not stdout/err will get aggregated together
         # as the process runs.  this has memory usage implications, so sometimes
         # with long-running processes with a lot of data, it makes sense to
@@ -512,7 +860,9 @@ class Command(object):
         # if any redirection is used for stdout or stderr, internal buffering
         # of that data is not stored.  this forces it to be stored, as if
         # the output is being T'd to both the redirected destination and our
-        # internal buffers
+        # internal buffers.  output redirected to a file (or anything else
+        # with a fileno()) is normally written there by the process itself,
+        # so this also means that it goes through us instead
         "tee": None,
     }
 
@@ -522,6 +872,9 @@ class Command(object):
         #("fg", "bg", "Command can't be run in the foreground and background"),
         ("err", "err_to_out", "Stderr is already being redirected"),
         ("piped", "iter", "You cannot iterate when this command is being piped"),
+        ("piped", "iter_batch", "You cannot iterate when this command is being piped"),
+        ("out_spill", "out_maxbytes", "Spilled stdout is always kept in full"),
+        ("err_spill", "err_maxbytes", "Spilled stderr is always kept in full"),
     )
 
 
@@ -539,61 +892,104 @@ class Command(object):
         path = resolve_program(program)
         if not path: raise CommandNotFound(program)
 
-        cmd = cls(path)
+        cmd = cls._from_resolved(path)
         if default_kwargs:
             cmd = cmd.bake(**default_kwargs)
 
         return cmd
 
 
+    # for when we already know that path is an executable, like when we've
+    # just resolved it, or when we're baking a new command from an existing
+    # one, so that we don't go looking for it all over again
+    @classmethod
+    def _from_resolved(cls, path):
+        cmd = cls.__new__(cls)
+        cmd._setup(path)
+        return cmd
+
+
     def __init__(self, path):
         path = which(path)
         if not path:
             raise CommandNotFound(path)
+        self._setup(path)
+
+
+    def _setup(self, path):
         self._path = path
 
         self._partial = False
         self._partial_baked_args = []
         self._partial_call_args = {}
+        self._call_plan = None
 
         # bugfix for functools.wraps.  issue #121
         self.__name__ = repr(self)
 
 
     def __getattribute__(self, name):
-        # convenience
-        getattr = partial(object.__getattribute__, self)
+        # this gets called for every attribute we use internally, so it needs
+        # to be quick about those
+        getattr = object.__getattribute__
 
-        if name.startswith("_"): return getattr(name)
-        if name == "bake": return getattr("bake")
+        if name.startswith("_"): return getattr(self, name)
+        if name == "bake": return getattr(self, "bake")
         if name.endswith("_"): name = name[:-1]
 
-        return getattr("bake")(name)
+        return getattr(self, "bake")(name)
 
 
     @staticmethod
     def _extract_call_args(kwargs, to_override={}):
         kwargs = kwargs.copy()
-        call_args = {}
-        for parg, default in Command._call_args.items():
-            key = "_" + parg
-
-            if key in kwargs:
-                call_args[parg] = kwargs[key]
-                del kwargs[key]
-            elif parg in to_override:
-                call_args[parg] = to_override[parg]
-
-        # test for incompatible call args
-        s1 = set(call_args.keys())
+        call_args = to_override.copy()
+
+        # we only look at the kwargs we were given, instead of looking for
+        # every special kwarg there is in them
+        for key in [k for k in kwargs if k.startswith("_")]:
+            parg = key[1:]
+            if parg in Command._call_args:
+                call_args[parg] = kwargs.pop(key)
+
+        Command._check_call_args(call_args)
+        return call_args, kwargs
+
+
+    @staticmethod
+    def _check_call_args(call_args):
+        """ raises a TypeError for special kwargs that can't be used
+        together """
         for args in Command._incompatible_call_args:
             args = list(args)
             error = args.pop()
 
-            if s1.issuperset(args):
+            for arg in args:
+                if arg not in call_args: break
+            else:
                 raise TypeError("Invalid special arguments %r: %s" % (args, error))
 
-        return call_args, kwargs
+
+    def _get_call_plan(self):
+        """ a command's special kwargs and baked arguments don't change after
+        it has been created (baking makes a new command), so everything that
+        only depends on those is worked out the first time we're called:
+        the default special kwargs merged with the baked ones, and our
+        encoded path.  a call then only has to copy the special kwargs and
+        deal with its own arguments """
+        plan = self._call_plan
+        if plan is None:
+            Command._check_call_args(self._partial_call_args)
+
+            call_args = Command._call_args.copy()
+            call_args.update(self._partial_call_args)
+            encoding = call_args["encoding"]
+
+            path = self._path
+            if IS_PY3: path = bytes(path, encoding)
+
+            plan = self._call_plan = (call_args, encoding, path)
+        return plan
 
 
     def _aggregate_keywords(self, keywords, sep, raw=False):
@@ -646,17 +1042,15 @@ If you're using glob.glob(), please use sh.glob() instead." % self._path, stackl
 
     # TODO needs documentation
     def bake(self, *args, **kwargs):
-        fn = Command(self._path)
+        fn = Command._from_resolved(self._path)
         fn._partial = True
 
         call_args, kwargs = self._extract_call_args(kwargs)
 
         pruned_call_args = call_args
-        for k, v in Command._call_args.items():
-            try:
-                if pruned_call_args[k] == v:
-                    del pruned_call_args[k]
-            except KeyError: continue
+        for k, v in list(pruned_call_args.items()):
+            if Command._call_args[k] == v:
+                del pruned_call_args[k]
 
         fn._partial_call_args.update(self._partial_call_args)
         fn._partial_call_args.update(pruned_call_args)
@@ -695,31 +1089,50 @@ If you're using glob.glob(), please use sh.glob() instead." % self._path, stackl
 
 
     def __call__(self, *args, **kwargs):
-        kwargs = kwargs.copy()
-        args = list(args)
+        plan_call_args, plan_encoding, path = self._get_call_plan()
 
         cmd = []
 
-        # aggregate any 'with' contexts
-        call_args = Command._call_args.copy()
-        for prepend in self._prepend_stack:
-            # don't pass the 'with' call arg
-            pcall_args = prepend.call_args.copy()
-            try: del pcall_args["with"]
-            except: pass
+        if not self._prepend_stack:
+            call_args = plan_call_args.copy()
 
-            call_args.update(pcall_args)
-            cmd.extend(prepend.cmd)
-
-        if IS_PY3:
-            cmd.append(bytes(self._path, call_args["encoding"]))
+        # aggregate any 'with' contexts.  the special kwargs of the command
+        # being called take priority over theirs
         else:
-            cmd.append(self._path)
-
-        # here we extract the special kwargs and override any
-        # special kwargs from the possibly baked command
-        tmp_call_args, kwargs = self._extract_call_args(kwargs, self._partial_call_args)
-        call_args.update(tmp_call_args)
+            call_args = Command._call_args.copy()
+            for prepend in self._prepend_stack:
+                # don't pass the 'with' call arg
+                pcall_args = prepend.call_args.copy()
+                try: del pcall_args["with"]
+                except: pass
+
+                call_args.update(pcall_args)
+                cmd.extend(prepend.cmd)
+
+            call_args.update(self._partial_call_args)
+
+        # here we extract the special kwargs, which override any special
+        # kwargs from the possibly baked command
+        given_call_args = self._partial_call_args
+        if kwargs:
+            tmp_call_args, kwargs = self._extract_call_args(kwargs,
+                self._partial_call_args)
+            call_args.update(tmp_call_args)
+            given_call_args = tmp_call_args
+
+        # processes in a shell pipeline write into a plain pipe, not a tty
+        if call_args["piped"] == "direct" and call_args["out"] is None:
+            call_args["tty_out"] = False
+
+        # and binary output isn't meant for a terminal either.  a plain pipe
+        # is read in much bigger pieces than a tty is, so unless we've been
+        # asked for a tty, that's what it gets
+        if call_args["binary"] and "tty_out" not in given_call_args:
+            call_args["tty_out"] = False
+
+        if IS_PY3 and call_args["encoding"] != plan_encoding:
+            path = bytes(self._path, call_args["encoding"])
+        cmd.append(path)
 
         if not isinstance(call_args["ok_code"], (tuple, list)):
             call_args["ok_code"] = [call_args["ok_code"]]
@@ -727,33 +1140,42 @@ If you're using glob.glob(), please use sh.glob() instead." % self._path, stackl
 
         # check if we're piping via composition
         stdin = call_args["in"]
-        if args:
-            first_arg = args.pop(0)
-            if isinstance(first_arg, RunningCommand):
-                # it makes sense that if the input pipe of a command is running
-                # in the background, then this command should run in the
-                # background as well
-                if first_arg.call_args["bg"]: call_args["bg"] = True
-                stdin = first_arg.process._pipe_queue
-
-            else:
-                args.insert(0, first_arg)
-
-        processed_args = self._compile_args(args, kwargs, call_args["long_sep"])
-
-        # makes sure our arguments are broken up correctly
-        split_args = self._partial_baked_args + processed_args
-
-        final_args = split_args
-
-        cmd.extend(final_args)
-
-
-        # stdout redirection
+        if args and isinstance(args[0], RunningCommand):
+            first_arg = args[0]
+            args = args[1:]
+
+            # it makes sense that if the input pipe of a command is running
+            # in the background, then this command should run in the
+            # background as well
+            if first_arg.call_args["bg"]: call_args["bg"] = True
+
+            # if nothing in python is looking at its output, we take its
+            # stdout pipe for our stdin, so that the data goes straight from
+            # one process to the other, like in a shell pipeline.  a tty
+            # can't be swapped for a pipe though, so then we need python to
+            # read it and feed it to us
+            process = first_arg.process
+            stdin = None
+            if call_args["tty_in"]: process._read_direct_pipe()
+            else: stdin = process._claim_direct_pipe()
+            if not stdin:
+                stdin = process._subscribe_pipe()
+                process._limit_pipe(PIPE_MAXBYTES)
+                process._limit_capture(PIPE_MAXBYTES)
+
+        # our baked arguments are already encoded
+        cmd.extend(self._partial_baked_args)
+        if args or kwargs:
+            cmd.extend(self._compile_args(args, kwargs, call_args["long_sep"]))
+
+
+        # stdout redirection.  anything that isn't a callback or a file-like
+        # object (or a socket) is a path
         stdout = call_args["out"]
         if stdout \
             and not callable(stdout) \
             and not hasattr(stdout, "write") \
+            and not hasattr(stdout, "fileno") \
             and not isinstance(stdout, (cStringIO, StringIO)):
 
             stdout = open(str(stdout), "wb")
@@ -762,6 +1184,7 @@ If you're using glob.glob(), please use sh.glob() instead." % self._path, stackl
         # stderr redirection
         stderr = call_args["err"]
         if stderr and not callable(stderr) and not hasattr(stderr, "write") \
+            and not hasattr(stderr, "fileno") \
             and not isinstance(stderr, (cStringIO, StringIO)):
             stderr = open(str(stderr), "wb")
 
@@ -771,12 +1194,523 @@ If you're using glob.glob(), please use sh.glob() instead." % self._path, stackl
 
 
 
+# runs a command once for every item of inputs, with no more than jobs of them
+# running at a time.  we only take another item from inputs when there's room
+# for its command to run, so inputs can be a generator of any length, and what
+# we're holding onto doesn't grow with it.  with ordered, commands that finish
+# before the ones ahead of them wait to be given back, and up to jobs of them
+# can be waiting like that before we stop starting new ones
+def parallel(cmd, inputs, jobs=None, ordered=False, fail_fast=True,
+        template=None):
+    """ yields (item, finished command) for each item of inputs, as the
+    commands finish, or in the order of inputs if ordered is True.  an item is
+    the command's arguments: a tuple of them, a dict of keyword arguments, or
+    a single argument.  template is a tuple of arguments to use instead, where
+    the strings are formatted with the item, like ("{0}", "{0}.png").
+
+    a command that fails raises its ErrorReturnCode, once the others that are
+    still running have been killed.  with fail_fast=False, the ErrorReturnCode
+    is given back in place of the command, and we carry on.
+
+    this hides any "parallel" program, like GNU parallel.  use sh.parallel_
+    or sh.Command("parallel") to run that instead """
+    if jobs is None:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+    if jobs < 1: raise ValueError("jobs must be at least 1")
+
+    inputs = iter(inputs)
+    finished = Queue()
+    running = {}
+    waiting = {}
+    started = returned = 0
+    exhausted = False
+
+    try:
+        while True:
+            while not exhausted and len(running) < jobs \
+                    and len(waiting) < jobs:
+                try: item = next(inputs)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                args, kwargs = _parallel_args(item, template)
+                kwargs["_bg"] = True
+                p = cmd(*args, **kwargs)
+                running[started] = (item, p)
+                p.process.add_done_callback(partial(finished.put, started))
+                started += 1
+
+            if not running: return
+
+            while True:
+                try: index = finished.get(True,
+                    RunningCommand._pipe_get_timeout)
+                except Empty: continue
+                break
+
+            item, p = running.pop(index)
+            failed = False
+            try: result = p.wait()
+            except ErrorReturnCode as e:
+                result = e
+                failed = fail_fast
+
+            if not ordered:
+                if failed: raise result
+                yield item, result
+                continue
+
+            # in order, a failure is only raised when it's its turn, after
+            # everything before it has been given back
+            waiting[index] = (item, result, failed)
+            while returned in waiting:
+                item, result, failed = waiting.pop(returned)
+                returned += 1
+                if failed: raise result
+                yield item, result
+
+    # we're here early if a command failed, or if whoever was iterating over
+    # us stopped.  either way, nobody wants what's still running
+    finally:
+        for item, p in running.values(): p.process.kill()
+        for item, p in running.values(): p.process.wait()
+
+
+def _parallel_args(item, template):
+    """ the args and kwargs for a command in parallel() to run with item """
+    if template is None:
+        if isinstance(item, dict): return (), dict(item)
+        if isinstance(item, (tuple, list)): return tuple(item), {}
+        return (item,), {}
+
+    if isinstance(item, dict): fmt = lambda arg: arg.format(**item)
+    elif isinstance(item, (tuple, list)): fmt = lambda arg: arg.format(*item)
+    else: fmt = lambda arg: arg.format(item)
+
+    args = [fmt(arg) if isinstance(arg, basestring) else arg
+        for arg in template]
+    return tuple(args), {}
+
+
+
+
 # used in redirecting
 STDOUT = -1
 STDERR = -2
 
 
 
+def _redirect_fileno(handler):
+    """ returns the fd behind an _in, _out or _err handler that the process
+    can use itself (a real file, a socket, a pipe...), or None if we have to
+    move the data to or from the handler ourselves """
+    if handler is None or callable(handler): return None
+
+    # a RunningCommand's __getattr__ would wait for it to finish
+    if isinstance(handler, RunningCommand): return None
+
+    fileno = getattr(handler, "fileno", None)
+    if fileno is None: return None
+
+    # StringIO and friends have a fileno() that only raises
+    try: return fileno()
+    except (ValueError, IOError, OSError): return None
+
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+# F_SETPIPE_SZ is only in the fcntl module from python 3.10 on
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ",
+    1031 if sys.platform.startswith("linux") else None)
+
+def _set_pipe_size(fd, size):
+    """ sets the capacity of the pipe that fd is an end of, if we can.  the
+    kernel rounds it up to a power of two number of pages """
+    if not size or _F_SETPIPE_SZ is None: return
+    # an unprivileged process can't go over the system's max pipe size, and
+    # can't shrink a pipe below what's already in it
+    try: fcntl.fcntl(fd, _F_SETPIPE_SZ, size)
+    except (IOError, OSError): pass
+
+
+
+# close_range(2) closes every fd in a range with a single syscall.  python
+# doesn't expose it, so we look for libc's wrapper (glibc 2.34+) with ctypes.
+# we do this in the parent, the first time we need it, so that the child has
+# nothing to do but call it
+_libc_close_range = None
+
+def _get_close_range():
+    global _libc_close_range
+    if _libc_close_range is None:
+        _libc_close_range = False
+        try:
+            import ctypes
+            close_range = ctypes.CDLL(None, use_errno=True).close_range
+            close_range.argtypes = (ctypes.c_uint, ctypes.c_uint, ctypes.c_int)
+            _libc_close_range = close_range
+        except (ImportError, OSError, AttributeError): pass
+    return _libc_close_range
+
+
+def _close_fds(pass_fds, close_range):
+    """ closes every fd from 3 up, except for the ones in pass_fds.  this runs
+    in the child, between fork and exec.  closing everything up to
+    RLIMIT_NOFILE one at a time is a million syscalls on a host that sets it to
+    a million, so we only do that if we have no better way """
+
+    # the ranges of fds between the ones we're keeping open
+    ranges = []
+    low = 3
+    for fd in sorted(pass_fds):
+        if fd < low: continue
+        if fd > low: ranges.append((low, fd - 1))
+        low = fd + 1
+    ranges.append((low, None))
+
+    if close_range:
+        failed = False
+        for low, high in ranges:
+            if high is None: high = 0xffffffff
+            if close_range(low, high, 0) != 0: failed = True
+        if not failed: return
+
+    # next best is to close only what's actually open
+    for fd_dir in ("/proc/self/fd", "/dev/fd"):
+        try: open_fds = os.listdir(fd_dir)
+        except OSError: continue
+
+        for fd in open_fds:
+            fd = int(fd)
+            if fd > 2 and fd not in pass_fds:
+                try: os.close(fd)
+                except OSError: pass
+        return
+
+    max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    for low, high in ranges:
+        if high is None: high = max_fd - 1
+        os.closerange(low, high + 1)
+
+
+# epoll has no limit on the fd numbers it can watch, unlike select, which
+# falls over once an fd goes past FD_SETSIZE.  we only fall back to select on
+# platforms without epoll (osx's poll doesn't work on ptys, so we skip it)
+class _EpollPoller(object):
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._registered = set()
+
+    def modify(self, fd, readable, writable):
+        mask = 0
+        if readable: mask |= select.EPOLLIN
+        if writable: mask |= select.EPOLLOUT
+
+        if not mask:
+            if fd in self._registered:
+                self._registered.discard(fd)
+                try: self._epoll.unregister(fd)
+                except (IOError, OSError, ValueError): pass
+        elif fd in self._registered:
+            self._epoll.modify(fd, mask)
+        else:
+            self._epoll.register(fd, mask)
+            self._registered.add(fd)
+
+    def poll(self, timeout):
+        if timeout is None: timeout = -1
+        ready = []
+        for fd, mask in self._epoll.poll(timeout):
+            # a hangup or an error is reported to both the reader and the
+            # writer, so they can find out about it when they try their io
+            readable = mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR)
+            writable = mask & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR)
+            ready.append((fd, readable, writable))
+        return ready
+
+
+class _SelectPoller(object):
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+    def modify(self, fd, readable, writable):
+        if readable: self._readers.add(fd)
+        else: self._readers.discard(fd)
+        if writable: self._writers.add(fd)
+        else: self._writers.discard(fd)
+
+    def poll(self, timeout):
+        readers, writers, _ = select.select(list(self._readers),
+            list(self._writers), [], timeout)
+        readers = set(readers)
+        writers = set(writers)
+        return [(fd, fd in readers, fd in writers) for fd in readers | writers]
+
+
+
+class _Timer(object):
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+
+# the reactor is a single, process-wide thread that does the io for every
+# OProc.  previously each OProc started its own input and output threads, and
+# with a few hundred background commands that's a lot of threads fighting over
+# the GIL.  instead, each OProc registers its fds with the reactor, and the
+# reactor calls back into the OProc when those fds become ready.
+#
+# the interface intentionally mirrors a small subset of an asyncio event loop
+# (add_reader, add_writer, call_later, call_soon_threadsafe).  the add/remove
+# methods must only be called from the reactor thread, so anything that lives
+# in another thread has to go through call_soon_threadsafe
+class Reactor(object):
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            reactor = cls._instance
+
+            # if we've forked, the reactor thread didn't come with us, so we
+            # need a fresh reactor for this process
+            if reactor is None or reactor._pid != os.getpid():
+                reactor = cls()
+                cls._instance = reactor
+                atexit.register(reactor.stop)
+            return reactor
+
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._stopped = False
+        self.log = Logger("reactor")
+
+        if hasattr(select, "epoll"): self._poller = _EpollPoller()
+        else: self._poller = _SelectPoller()
+
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._timer_seq = 0
+
+        # these are the fds whose callbacks are currently running.  we need
+        # to know about them if a callback blocks on some other command, in
+        # which case we poll re-entrantly (see run_until)
+        self._dispatching = []
+
+        self._ready = deque()
+        self._ready_lock = threading.Lock()
+
+        # the self-pipe lets other threads wake us up out of our poll
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        _set_nonblocking(self._wakeup_read)
+        _set_nonblocking(self._wakeup_write)
+        self._poller.modify(self._wakeup_read, True, False)
+
+        self._thread = threading.Thread(target=self._run, name="sh reactor")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def in_thread(self):
+        return threading.current_thread() is self._thread
+
+
+    def _update(self, fd):
+        self._poller.modify(fd, fd in self._readers, fd in self._writers)
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None: self._update(fd)
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        if self._writers.pop(fd, None) is not None: self._update(fd)
+
+
+    def call_later(self, delay, callback):
+        timer = _Timer(_time.time() + delay, callback)
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (timer.when, self._timer_seq, timer))
+        return timer
+
+    def call_soon_threadsafe(self, callback):
+        with self._ready_lock:
+            self._ready.append(callback)
+        self._wakeup()
+
+    def _wakeup(self):
+        try: os.write(self._wakeup_write, "x".encode())
+        except OSError: pass
+
+
+    def run_until(self, predicate, timeout=None):
+        """ runs the reactor in the current thread until predicate() is true,
+        or until timeout seconds have passed.  this is for when a callback
+        (which runs in the reactor thread) waits on a command, which would
+        otherwise deadlock, since nobody would be around to do that command's
+        io """
+
+        # the fds that are in the middle of a callback can't be dispatched
+        # again until that callback returns, so we take them out of the
+        # poller while we run nested
+        paused = [fd for fd in self._dispatching if fd is not None]
+        for fd in paused: self._poller.modify(fd, False, False)
+
+        deadline = None
+        if timeout is not None: deadline = _time.time() + timeout
+
+        try:
+            while not predicate():
+                max_timeout = None
+                if deadline is not None:
+                    max_timeout = deadline - _time.time()
+                    if max_timeout <= 0: break
+                self._run_once(paused, max_timeout)
+        finally:
+            for fd in paused: self._update(fd)
+
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup()
+
+    def _run(self):
+        try:
+            while not self._stopped:
+                self._run_once()
+        except:
+            # python 2 tears down module globals at interpreter shutdown, out
+            # from under daemon threads like us.  there's nothing to report
+            if not self._stopped: raise
+
+
+    def _next_timeout(self):
+        if self._ready: return 0
+
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+
+        if not self._timers: return None
+        return max(0, self._timers[0][0] - _time.time())
+
+
+    def _run_once(self, paused=(), max_timeout=None):
+        timeout = self._next_timeout()
+        if max_timeout is not None:
+            if timeout is None: timeout = max_timeout
+            else: timeout = min(timeout, max_timeout)
+
+        try: events = self._poller.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR: events = []
+            else: raise
+
+        for fd, readable, writable in events:
+            if fd == self._wakeup_read:
+                try: os.read(self._wakeup_read, 4096)
+                except OSError: pass
+                continue
+
+            if fd in paused: continue
+
+            # callbacks may remove fds (their own, or others'), so we look them
+            # up fresh each time
+            if readable and fd in self._readers:
+                self._dispatch(fd, self._readers[fd])
+            if writable and fd in self._writers:
+                self._dispatch(fd, self._writers[fd])
+
+        now = _time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled: self._dispatch(None, timer.callback)
+
+        with self._ready_lock:
+            ready = self._ready
+            self._ready = deque()
+        for callback in ready: self._dispatch(None, callback)
+
+
+    def _dispatch(self, fd, callback):
+        self._dispatching.append(fd)
+        try: callback()
+        except Exception:
+            # a misbehaving callback (usually a user's stdout/stderr callback)
+            # shouldn't take the io of every other process down with it
+            traceback.print_exc()
+        finally:
+            self._dispatching.pop()
+
+
+
+
+# this lets an asyncio event loop stand in for our reactor, so that processes
+# started with _async=True do their io on the caller's event loop, rather than
+# on our reactor thread
+class AsyncioReactor(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self._thread = threading.current_thread()
+
+    @classmethod
+    def get(cls):
+        try: import asyncio
+        except ImportError:
+            raise RuntimeError("_async requires asyncio (python 3.4+)")
+
+        get_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+        return cls(get_loop())
+
+    def in_thread(self):
+        return threading.current_thread() is self._thread
+
+    def add_reader(self, fd, callback):
+        self.loop.add_reader(fd, callback)
+
+    def remove_reader(self, fd):
+        self.loop.remove_reader(fd)
+
+    def add_writer(self, fd, callback):
+        self.loop.add_writer(fd, callback)
+
+    def remove_writer(self, fd):
+        self.loop.remove_writer(fd)
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+    def call_soon_threadsafe(self, callback):
+        self.loop.call_soon_threadsafe(callback)
+
+    def run_until(self, predicate, timeout=None):
+        # we can't run the event loop from inside of itself
+        if not predicate():
+            raise RuntimeError("Can't block on an _async command from its \
+event loop's thread, await it instead")
+
+
+
 # Process open = Popen
 # Open Process = OProc
 class OProc(object):
@@ -791,6 +1725,54 @@ class OProc(object):
 
         self._single_tty = self.call_args["tty_in"] and self.call_args["tty_out"]
 
+        # our stdin is another process's stdout pipe, which the child reads
+        # from itself
+        direct_stdin = None
+        if isinstance(stdin, DirectPipe): direct_stdin = stdin
+
+        # stdin from something with an fd of its own (a file, sys.stdin, a
+        # socket...) is read by the process itself.  a tty can't be swapped
+        # for it though, so with _tty_in we still feed it through
+        stdin_fd = None
+        if not direct_stdin and not self.call_args["tty_in"]:
+            stdin_fd = _redirect_fileno(stdin)
+
+        # a buffered file object may have read past where it says it is, so
+        # we put the fd where it says it is.  a text file's position is only
+        # known in bytes by the binary file underneath it, once it's seeked
+        if stdin_fd is not None:
+            try:
+                stdin.seek(stdin.tell())
+                pos = getattr(stdin, "buffer", stdin).tell()
+                os.lseek(stdin_fd, pos, os.SEEK_SET)
+            except (AttributeError, ValueError, IOError, OSError): pass
+
+        # and our stdout is a pipe that whatever we're piped into can claim
+        # for the same thing.  we only do that when nothing in python wants
+        # to see our output
+        piped = self.call_args["piped"]
+        self._direct_stdout = (piped == "direct" or
+            (piped and self.call_args["no_out"])) \
+            and not self.call_args["tty_out"] and stdout is None \
+            and pipe is STDOUT and not self.call_args["no_pipe"] \
+            and not self.call_args["tee"]
+
+        # output that's redirected to something with an fd of its own gets
+        # written there by the process, like a shell redirection, without us
+        # ever seeing it.  we still do it ourselves if we've been asked to
+        # keep a copy with _tee, or if stdout has to be a tty
+        stdout_fd = stderr_fd = None
+        if not self.call_args["tty_out"] \
+                and self.call_args["tee"] not in (True, "out"):
+            stdout_fd = _redirect_fileno(stdout)
+        if stderr is not STDOUT and self.call_args["tee"] != "err":
+            stderr_fd = _redirect_fileno(stderr)
+
+        # whatever python has buffered up has to get there before what the
+        # process writes
+        for handler, fd in ((stdout, stdout_fd), (stderr, stderr_fd)):
+            if fd is not None and hasattr(handler, "flush"): handler.flush()
+
         # this logic is a little convoluted, but basically this top-level
         # if/else is for consolidating input and output TTYs into a single
         # TTY.  this is the only way some secure programs like ssh will
@@ -806,16 +1788,26 @@ class OProc(object):
 
         # do not consolidate stdin and stdout
         else:
-            if self.call_args["tty_in"]:
+            if direct_stdin:
+                self._slave_stdin_fd, self._stdin_fd = direct_stdin.fd, None
+            elif stdin_fd is not None:
+                self._slave_stdin_fd, self._stdin_fd = os.dup(stdin_fd), None
+            elif self.call_args["tty_in"]:
                 self._slave_stdin_fd, self._stdin_fd = pty.openpty()
             else:
                 self._slave_stdin_fd, self._stdin_fd = os.pipe()
+                _set_pipe_size(self._stdin_fd, self.call_args["pipe_size"])
+
+            # we hand the process a dup of the fd, so that it's ours to close
+            if stdout_fd is not None:
+                self._stdout_fd, self._slave_stdout_fd = None, os.dup(stdout_fd)
 
             # tty_out is usually the default
-            if self.call_args["tty_out"]:
+            elif self.call_args["tty_out"]:
                 self._stdout_fd, self._slave_stdout_fd = pty.openpty()
             else:
                 self._stdout_fd, self._slave_stdout_fd = os.pipe()
+                _set_pipe_size(self._stdout_fd, self.call_args["pipe_size"])
 
             # unless STDERR is going to STDOUT, it ALWAYS needs to be a pipe,
             # and never a PTY.  the reason for this is not totally clear to me,
@@ -823,12 +1815,24 @@ class OProc(object):
             # CTTY (because STDOUT is), the STDERR buffer won't always flush
             # by the time the process exits, and the data will be lost.
             # i've only seen this on OSX.
-            if stderr is not STDOUT:
+            if stderr_fd is not None:
+                self._stderr_fd, self._slave_stderr_fd = None, os.dup(stderr_fd)
+            elif stderr is not STDOUT:
                 self._stderr_fd, self._slave_stderr_fd = os.pipe()
+                _set_pipe_size(self._stderr_fd, self.call_args["pipe_size"])
+
+        self.pid = None
+        if self._can_posix_spawn(stderr):
+            self.pid = self._posix_spawn(cmd, stderr)
 
         gc_enabled = gc.isenabled()
-        if gc_enabled: gc.disable()
-        self.pid = os.fork()
+        if self.pid is None:
+            pass_fds = frozenset(fd for fd in self.call_args["pass_fds"]
+                if fd > 2)
+            close_range = _get_close_range()
+
+            if gc_enabled: gc.disable()
+            self.pid = os.fork()
 
 
         # child
@@ -857,10 +1861,11 @@ class OProc(object):
                 tty.setraw(self._stdout_fd)
 
 
-            os.close(self._stdin_fd)
+            if self._stdin_fd is not None: os.close(self._stdin_fd)
             if not self._single_tty:
-                os.close(self._stdout_fd)
-                if stderr is not STDOUT: os.close(self._stderr_fd)
+                if self._stdout_fd is not None: os.close(self._stdout_fd)
+                if stderr is not STDOUT and self._stderr_fd is not None:
+                    os.close(self._stderr_fd)
 
 
             if self.call_args["cwd"]: os.chdir(self.call_args["cwd"])
@@ -872,9 +1877,13 @@ class OProc(object):
             if stderr is STDOUT: os.dup2(self._slave_stdout_fd, 2)
             else: os.dup2(self._slave_stderr_fd, 2)
 
-            # don't inherit file descriptors
-            max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
-            os.closerange(3, max_fd)
+            # don't inherit file descriptors, except the ones we've been
+            # asked to pass along.  those may be close-on-exec, like
+            # everything that python 3 opens, so we clear that
+            _close_fds(pass_fds, close_range)
+            for fd in pass_fds:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
 
 
             # set our controlling terminal
@@ -906,26 +1915,45 @@ class OProc(object):
             self.started = _time.time()
             self.cmd = cmd
             self.exit_code = None
-
-            self.stdin = stdin or Queue()
-            self._pipe_queue = Queue()
-
-            # this is used to prevent a race condition when we're waiting for
-            # a process to end, and the OProc's internal threads are also checking
-            # for the processes's end
-            self._wait_lock = threading.Lock()
-
-            # these are for aggregating the stdout and stderr.  we use a deque
-            # because we don't want to overflow
-            self._stdout = deque(maxlen=self.call_args["internal_bufsize"])
-            self._stderr = deque(maxlen=self.call_args["internal_bufsize"])
+            self.rusage = None
+
+            self.stdin = stdin or PipeQueue()
+
+            # our output only goes on a pipe queue if something is going to
+            # read it from there.  if we're not being iterated over or piped,
+            # we don't know that yet, and whatever pipes us later gets what
+            # we've captured up until then
+            self._pipe_queue = None
+            self._pipe_limited = False
+            self._pipe_backlog = None
+            self._pipe_backlog_lock = threading.RLock()
+            if self.call_args["piped"] or self.call_args["iter"] \
+                    or self.call_args["iter_noblock"]:
+                self._make_pipe_queue()
+
+            # only one thread at a time gets to reap the process.  usually
+            # that's the reactor, when it hears about the process exiting, but
+            # anyone checking .alive might beat it to it
+            self._reap_lock = threading.Lock()
+            self._reap_error = None
+
+            # these are for aggregating the stdout and stderr
+            self._stdout = CaptureBuffer(self.call_args["out_maxbytes"],
+                self.call_args["maxbytes_drop"],
+                self.call_args["internal_bufsize"],
+                self.call_args["out_spill"])
+            self._stderr = CaptureBuffer(self.call_args["err_maxbytes"],
+                self.call_args["maxbytes_drop"],
+                self.call_args["internal_bufsize"],
+                self.call_args["err_spill"])
 
             if self.call_args["tty_in"]: self.setwinsize(self._stdin_fd)
 
 
-            self.log = Logger("process", repr(self))
+            self.log = Logger("process", self.__repr__)
 
-            os.close(self._slave_stdin_fd)
+            if direct_stdin: direct_stdin.close()
+            else: os.close(self._slave_stdin_fd)
             if not self._single_tty:
                 os.close(self._slave_stdout_fd)
                 if stderr is not STDOUT: os.close(self._slave_stderr_fd)
@@ -942,8 +1970,10 @@ class OProc(object):
 
             # this represents the connection from a Queue object (or whatever
             # we're using to feed STDIN) to the process's STDIN fd
-            self._stdin_stream = StreamWriter("stdin", self, self._stdin_fd,
-                self.stdin, self.call_args["in_bufsize"])
+            self._stdin_stream = None
+            if self._stdin_fd is not None:
+                self._stdin_stream = StreamWriter("stdin", self,
+                    self._stdin_fd, self.stdin, self.call_args["in_bufsize"])
 
 
             stdout_pipe = None
@@ -956,12 +1986,21 @@ class OProc(object):
             # that we use to aggregate all the output
             save_stdout = not self.call_args["no_out"] and \
                 (self.call_args["tee"] in (True, "out") or stdout is None)
-            self._stdout_stream = StreamReader("stdout", self, self._stdout_fd, stdout,
-                self._stdout, self.call_args["out_bufsize"], stdout_pipe,
-                save_data=save_stdout)
+
+            # a direct stdout is only read by us if we turn out to need it
+            self._direct_pipe = None
+            self._stdout_stream = None
+            if self._direct_stdout:
+                self._direct_pipe = DirectPipe(self._stdout_fd)
+            elif self._stdout_fd is not None:
+                self._stdout_stream = StreamReader("stdout", self,
+                    self._stdout_fd, stdout, self._stdout,
+                    self.call_args["out_bufsize"], stdout_pipe,
+                    save_data=save_stdout)
 
 
-            if stderr is STDOUT or self._single_tty: self._stderr_stream = None
+            if stderr is STDOUT or self._single_tty or self._stderr_fd is None:
+                self._stderr_stream = None
             else:
                 stderr_pipe = None
                 if pipe is STDERR and not self.call_args["no_pipe"]:
@@ -973,15 +2012,96 @@ class OProc(object):
                     self._stderr, self.call_args["err_bufsize"], stderr_pipe,
                     save_data=save_stderr)
 
-            # start the main io threads
-            self._input_thread = self._start_thread(self.input_thread, self._stdin_stream)
-            self._output_thread = self._start_thread(self.output_thread, self._stdout_stream, self._stderr_stream)
+            # the reactor does the io for us.  the only exception is stdin from
+            # a source that may block when we ask it for data (a generator, a
+            # callable, a file object), which still gets its own thread, so it
+            # can't hold up the io for every other process
+            if self.call_args["async"]: self._reactor = AsyncioReactor.get()
+            else: self._reactor = Reactor.get()
+            if self._stdin_stream:
+                self._stdin_stream.wakeup = partial(
+                    self._reactor.call_soon_threadsafe, self._resume_writing)
+            self._io_done = threading.Event()
+            self._finishing = False
+            self._done_callbacks = []
+            self._done_lock = threading.Lock()
+
+            # if we're being iterated over with "async for", this is the
+            # iteration waiting on the next chunk of the pipe
+            self._async_waiter = None
+            self._readers = [stream for stream in (self._stdout_stream,
+                self._stderr_stream) if stream is not None]
+
+            # the reactor does all of the writing to the process's stdin,
+            # whatever our input is, so that a process that stops reading it
+            # can't block anything
+            self._input_thread = None
+            if self._stdin_stream:
+                _set_nonblocking(self._stdin_fd)
+                if self._stdin_stream.blocking_source:
+                    self._input_thread = self._start_thread(self.input_thread,
+                        self._stdin_stream)
+
+            self._reactor.call_soon_threadsafe(self._start_io)
 
 
     def __repr__(self):
         return "<Process %d %r>" % (self.pid, self.cmd[:500])
 
 
+    # posix_spawn lets libc start the process with vfork (or the equivalent),
+    # which doesn't copy our page tables the way fork does, and which never
+    # runs any python in the child.  with a big parent heap that's a lot
+    # faster.  it can't do everything that our fork path does though (there's
+    # no tty setup, no chdir, and no way to clear close-on-exec on the fds
+    # we're passing along), so we only use it when we don't need those.
+    # python 3.7 has posix_spawn, but not its setsid argument
+    _use_posix_spawn = hasattr(os, "posix_spawn") and sys.version_info >= (3, 8)
+
+    def _can_posix_spawn(self, stderr):
+        if not OProc._use_posix_spawn: return False
+        if self.call_args["tty_in"] or self.call_args["tty_out"] \
+            or self.call_args["cwd"] or self.call_args["pass_fds"]:
+            return False
+
+        # a dup2 of an fd onto itself wouldn't clear its close-on-exec flag
+        slave_fds = [self._slave_stdin_fd, self._slave_stdout_fd]
+        if stderr is not STDOUT: slave_fds.append(self._slave_stderr_fd)
+        return min(slave_fds) > 2
+
+
+    def _posix_spawn(self, cmd, stderr):
+        """ starts the process with posix_spawn, returning its pid, or None if
+        that didn't work out and we should fork instead """
+
+        if stderr is STDOUT: slave_stderr_fd = self._slave_stdout_fd
+        else: slave_stderr_fd = self._slave_stderr_fd
+
+        file_actions = [
+            (os.POSIX_SPAWN_DUP2, self._slave_stdin_fd, 0),
+            (os.POSIX_SPAWN_DUP2, self._slave_stdout_fd, 1),
+            (os.POSIX_SPAWN_DUP2, slave_stderr_fd, 2),
+        ]
+
+        # fds that python opens are close-on-exec, so normally we don't need
+        # to close anything ourselves.  if we can, we close everything anyways,
+        # in case an extension module has left something open
+        closefrom = getattr(os, "POSIX_SPAWN_CLOSEFROM", None)
+        if closefrom is not None: file_actions.append((closefrom, 3))
+
+        env = self.call_args["env"]
+        if env is None: env = os.environ
+
+        # the child doesn't ignore SIGHUP, like it does with fork, but since
+        # it's in a session of its own with no controlling terminal, nothing
+        # is going to send it one when we exit
+        try:
+            return os.posix_spawn(cmd[0], cmd, env, file_actions=file_actions,
+                setsid=True)
+        except (OSError, NotImplementedError):
+            return None
+
+
     # also borrowed from pexpect.py
     @staticmethod
     def setwinsize(fd):
@@ -1002,10 +2122,12 @@ class OProc(object):
         return thrd
 
     def in_bufsize(self, buf):
-        self._stdin_stream.stream_bufferer.change_buffering(buf)
+        if self._stdin_stream:
+            self._stdin_stream.stream_bufferer.change_buffering(buf)
 
     def out_bufsize(self, buf):
-        self._stdout_stream.stream_bufferer.change_buffering(buf)
+        if self._stdout_stream:
+            self._stdout_stream.stream_bufferer.change_buffering(buf)
 
     def err_bufsize(self, buf):
         if self._stderr_stream:
@@ -1013,74 +2135,379 @@ class OProc(object):
 
 
     def input_thread(self, stdin):
-        done = False
-        while not done and self.alive:
-            self.log.debug("%r ready for more input", stdin)
-            done = stdin.write()
+        stdin.feed()
 
-        stdin.close()
 
+    # everything from here down to _finish_io runs in the reactor thread
 
-    def output_thread(self, stdout, stderr):
-        readers = []
-        errors = []
+    def _start_io(self):
+        for stream in self._readers:
+            self._reactor.add_reader(stream.stream,
+                partial(self._on_readable, stream))
 
-        if stdout is not None:
-            readers.append(stdout)
-            errors.append(stdout)
-        if stderr is not None:
-            readers.append(stderr)
-            errors.append(stderr)
+        stdin = self._stdin_stream
+        if stdin and not stdin.blocking_source:
+            self._reactor.add_writer(self._stdin_fd, self._on_writable)
 
-        while readers:
-            outputs, inputs, err = select.select(readers, [], errors, 0.1)
+        self._timeout_timer = None
+        if self.call_args["timeout"]:
+            self._timeout_timer = self._reactor.call_later(
+                self.call_args["timeout"], self._on_timeout)
 
-            # stdout and stderr
-            for stream in outputs:
-                self.log.debug("%r ready to be read from", stream)
-                done = stream.read()
-                if done: readers.remove(stream)
+        self._watch_exit()
 
-            for stream in err:
-                pass
 
-            # test if the process has been running too long
-            if self.call_args["timeout"]:
-                now = _time.time()
-                if now - self.started > self.call_args["timeout"]:
-                    self.log.debug("we've been running too long")
-                    self.kill()
+    # a stream that raises is finished with, like it had hit EOF, rather than
+    # being left on the reactor to raise again every time its fd is ready
+    def _on_readable(self, stream):
+        self.log.debug("%r ready to be read from", stream)
+        try: done = stream.read()
+        except Exception:
+            traceback.print_exc()
+            done = True
+        if done:
+            self._reactor.remove_reader(stream.stream)
+            self._readers.remove(stream)
+            if not self._readers: self._check_exit()
 
 
-        # this is here because stdout may be the controlling TTY, and
-        # we can't close it until the process has ended, otherwise the
-        # child will get SIGHUP.  typically, if we've broken out of
-        # the above loop, and we're here, the process is just about to
-        # end, so it's probably ok to aggressively poll self.alive
-        #
-        # the other option to this would be to do the CTTY close from
-        # the method that does the actual os.waitpid() call, but the
-        # problem with that is that the above loop might still be
-        # running, and closing the fd will cause some operation to
-        # fail.  this is less complex than wrapping all the ops
-        # in the above loop with out-of-band fd-close exceptions
-        while self.alive:
-            _time.sleep(0.001)
+    def _on_writable(self):
+        stdin = self._stdin_stream
+        if stdin.closed: return
+
+        self.log.debug("%r ready for more input", stdin)
+        try: done = stdin.write()
+        except Exception:
+            traceback.print_exc()
+            done = True
+        if done:
+            self._reactor.remove_writer(self._stdin_fd)
+            stdin.close()
+
+        # our source has nothing for us right now, so rather than spin on a
+        # writable fd, we stop watching it, until it tells us it has more
+        elif stdin.starved:
+            self._reactor.remove_writer(self._stdin_fd)
+
+
+    def _resume_writing(self):
+        if not self._stdin_stream.closed and not self._io_done.is_set():
+            self._reactor.add_writer(self._stdin_fd, self._on_writable)
+
+
+    def _on_timeout(self):
+        self.log.debug("we've been running too long")
+        self.kill()
 
-        if stdout:
-            stdout.close()
 
-        if stderr:
-            stderr.close()
+    # we find out about the process exiting through a pidfd, which becomes
+    # readable when the process ends.  on systems without pidfds, we fall back
+    # to checking on the process, less and less often the longer it runs
+    def _watch_exit(self):
+        self._pidfd = None
+        self._exit_timer = None
+
+        pidfd_open = getattr(os, "pidfd_open", None)
+        if pidfd_open:
+            try: self._pidfd = pidfd_open(self.pid)
+            except OSError: pass
+
+        if self._pidfd is not None:
+            self._reactor.add_reader(self._pidfd, self._check_exit)
+        else:
+            self._poll_exit(0.001)
+
+
+    def _poll_exit(self, delay):
+        if self._reap(): self._on_exit()
+        else:
+            self._exit_timer = self._reactor.call_later(delay,
+                partial(self._poll_exit, min(delay * 2, 0.05)))
+
+
+    # stdout may be the controlling TTY, and we can't close it until the
+    # process has ended, otherwise the child will get SIGHUP.  so we finish up
+    # our io when both the process has exited and we've hit EOF on all of our
+    # outputs, whichever of those happens last
+    #
+    # the other option to this would be to do the CTTY close from the method
+    # that does the actual os.waitpid() call, but the problem with that is
+    # that the reactor might still be reading, and closing the fd will cause
+    # some operation to fail
+    def _check_exit(self):
+        if self._reap(): self._on_exit()
+
+        # we've hit EOF, so the process is probably just about to end.  if
+        # we're polling, start checking on it aggressively again
+        elif not self._readers and self._exit_timer:
+            self._exit_timer.cancel()
+            self._poll_exit(0.001)
+
+
+    def _on_exit(self):
+        if self._pidfd is not None:
+            self._reactor.remove_reader(self._pidfd)
+            os.close(self._pidfd)
+            self._pidfd = None
+
+        if self._exit_timer:
+            self._exit_timer.cancel()
+            self._exit_timer = None
+
+        if not self._readers: self._finish_io()
+
+
+    def _finish_io(self):
+        if self._finishing: return
+        self._finishing = True
+        if self._timeout_timer: self._timeout_timer.cancel()
+
+        stdin = self._stdin_stream
+        if stdin and not stdin.closed:
+            self._reactor.remove_writer(self._stdin_fd)
+            stdin.close()
+
+        for stream in (self._stdout_stream, self._stderr_stream):
+            if stream:
+                self._reactor.remove_reader(stream.stream)
+                stream.close()
+
+        self._stdout.close()
+        self._stderr.close()
+        self._finish_callbacks()
+
+    # callbacks that are run on an executor may not have gotten to all of our
+    # output yet.  we're not done until they have
+    def _finish_callbacks(self):
+        for stream in (self._stdout_stream, self._stderr_stream):
+            if stream and stream.dispatcher:
+                dispatcher = stream.dispatcher
+                stream.dispatcher = None
+                dispatcher.when_idle(partial(
+                    self._reactor.call_soon_threadsafe, self._finish_callbacks))
+                return
+
+        # callbacks can be added from any thread, so being done, and taking
+        # the callbacks that we have to call for it, happen together
+        with self._done_lock:
+            self._io_done.set()
+            callbacks = self._done_callbacks
+            self._done_callbacks = []
+        for callback in callbacks: callback()
+
+
+    def add_done_callback(self, callback):
+        """ calls callback() from the reactor's thread once the process has
+        exited and all of its output has been read, or right away, from this
+        thread, if that has already happened """
+        with self._done_lock:
+            done = self._io_done.is_set()
+            if not done: self._done_callbacks.append(callback)
+        if done: callback()
+        else: self._read_direct_pipe()
+
+
+    # a direct stdout pipe that nobody has claimed yet is something we have
+    # to read ourselves if somebody waits on us, otherwise a process with more
+    # output than fits in the pipe would never finish.  what we read goes onto
+    # our pipe queue, for whatever we get piped into later.  it still isn't
+    # captured, so that .stdout is the same whichever way things happen
+
+    def _claim_direct_pipe(self):
+        """ hands over our stdout pipe to whoever is going to read from it,
+        or returns None if there is none to hand over """
+        pipe = self._direct_pipe
+        self._direct_pipe = None
+        return pipe
+
+    def _read_direct_pipe(self):
+        if self._direct_pipe:
+            self._reactor.call_soon_threadsafe(self._add_stdout_reader)
+
+    def _add_stdout_reader(self):
+        pipe = self._claim_direct_pipe()
+        if not pipe: return
+
+        # a buffer of no size keeps the data off of .stdout, but the reader
+        # still puts it on our pipe queue
+        reader = StreamReader("stdout", self, pipe.detach(), None,
+            CaptureBuffer(0), self.call_args["out_bufsize"], self._pipe_queue)
+
+        # we've already finished, so whatever is left is sitting in the pipe.
+        # the process that wrote it is gone, but something it started may
+        # still have the pipe open, so we can't just read until EOF here
+        if self._io_done.is_set():
+            self._reactor.add_reader(reader.stream,
+                partial(self._on_orphan_readable, reader))
+            return
+
+        self._stdout_stream = reader
+        self._readers.append(reader)
+        self._reactor.add_reader(reader.stream,
+            partial(self._on_readable, reader))
+
+    def _on_orphan_readable(self, reader):
+        if reader.read():
+            self._reactor.remove_reader(reader.stream)
+            reader.close()
+
+
+    # when whatever reads our pipe queue falls too far behind, we stop reading
+    # the process's output, so that the kernel pipe fills up and blocks the
+    # process, rather than us buffering up everything it writes.  we start
+    # again once the queue is half empty.  with "async for", the consumer's
+    # pace is what sets how fast we read from the process
+
+    def _make_pipe_queue(self):
+        self._pipe_queue = PipeQueue()
+
+        maxbytes = self.call_args["pipe_maxbytes"]
+        if maxbytes is None and self.call_args["async"] \
+                and self.call_args["iter"]:
+            maxbytes = PIPE_MAXBYTES
+        if maxbytes is not None: self._limit_pipe(maxbytes)
+
+    def _subscribe_pipe(self):
+        """ returns our pipe queue, making it if nobody has subscribed to it
+        before, with everything that we've captured so far already on it """
+        if self._pipe_queue is not None: return self._pipe_queue
+        self._make_pipe_queue()
+
+        # the reactor is the one putting our output on the queue, so we let it
+        # decide where what we've captured ends, and new output begins
+        if self._io_done.is_set(): self._fill_pipe()
+        else: self._reactor.call_soon_threadsafe(self._fill_pipe)
+        return self._pipe_queue
+
+    def _fill_pipe(self, start=0):
+        stream = self._stdout_stream
+        if not stream or self.call_args["no_pipe"] or not stream.save_data:
+            return
+
+        # what we've captured goes on the queue in the same pieces that it
+        # would have, if it had been put there as it was read
+        chunks = self._stdout.chunks(stream.stream_bufferer.type, start)
+
+        # output that has spilled to disk is more than we want in memory at
+        # once, so it only goes on as whatever is reading the queue drains it
+        if self._stdout.spilled and start < len(self._stdout):
+            self._pipe_backlog = [chunks, start]
+            self._pipe_queue.add_get_listener(self._feed_pipe)
+            self._feed_pipe()
+            return
+
+        for chunk in chunks: self._pipe_queue.put(chunk)
+        if self._finishing: self._pipe_queue.put(None)
+        else: stream.pipe_queue = weakref.ref(self._pipe_queue)
+
+    # this is called from whichever thread took something off of the queue
+    def _feed_pipe(self):
+        queue = self._pipe_queue
+        with self._pipe_backlog_lock:
+            backlog = self._pipe_backlog
+            if backlog is None: return
+
+            while queue.nbytes < (queue.maxbytes or PIPE_MAXBYTES):
+                try: chunk = next(backlog[0])
+                except StopIteration: break
+                backlog[1] += len(chunk)
+                queue.put(chunk)
+            else: return
+
+            self._pipe_backlog = None
+            queue.remove_get_listener(self._feed_pipe)
+
+        # more may have been captured while we were at it.  like the first
+        # time, the reactor decides where that ends, and new output begins
+        fill = partial(self._fill_pipe, backlog[1])
+        if self._io_done.is_set(): fill()
+        else: self._reactor.call_soon_threadsafe(fill)
+
+    def _limit_pipe(self, maxbytes):
+        """ bounds our pipe queue at maxbytes, unless it already has a bound
+        """
+        if self._pipe_limited: return
+        self._pipe_limited = True
+        self._pipe_queue.maxbytes = maxbytes
+        self._pipe_queue.add_put_listener(self._on_pipe_put)
+        self._pipe_queue.add_get_listener(self._on_pipe_get)
+
+    # a command that's piped into another one may put any amount of output
+    # through, and bounding the pipe queue is no good if we keep all of it
+    # anyways.  so unless we've been told how much to keep, .stdout keeps
+    # maxbytes of it, like with _out_maxbytes.  and a line is kept whole until
+    # it ends, which output with no newlines never does, so unless something
+    # is looking at our output a line at a time, we stop splitting it into
+    # lines.  that happens in the reactor, after what we'd already captured
+    # has gone on the pipe queue
+    def _limit_capture(self, maxbytes):
+        if not self._io_done.is_set():
+            self._reactor.call_soon_threadsafe(
+                partial(self._bound_stdout, maxbytes))
+
+    def _bound_stdout(self, maxbytes):
+        if self.call_args["out_maxbytes"] is None \
+                and self.call_args["out_spill"] is None:
+            self._stdout.maxbytes = maxbytes
+
+        stream = self._stdout_stream
+        if stream and stream.handler is None and not self.call_args["iter"] \
+                and not self.call_args["iter_noblock"] \
+                and stream.stream_bufferer.type == 1:
+            stream.stream_bufferer.change_buffering(0)
+
+    def _pipe_stream(self):
+        for stream in (self._stdout_stream, self._stderr_stream):
+            if stream and stream.pipe_queue: return stream
+
+    def _pause_pipe(self):
+        stream = self._pipe_stream()
+        if stream not in self._readers or stream.paused or self._finishing:
+            return
+        stream.paused = True
+        self._reactor.remove_reader(stream.stream)
+
+        # whoever is reading the queue may have emptied it before we paused,
+        # in which case they didn't know to resume us
+        if self._pipe_queue.drained(): self._resume_pipe()
+
+    def _resume_pipe(self):
+        stream = self._pipe_stream()
+        if stream not in self._readers or not stream.paused or self._finishing:
+            return
+        stream.paused = False
+        self._reactor.add_reader(stream.stream,
+            partial(self._on_readable, stream))
+
+    # this is called from whichever thread took something off of the queue
+    def _on_pipe_get(self):
+        stream = self._pipe_stream()
+        if stream and stream.paused and self._pipe_queue.drained():
+            self._reactor.call_soon_threadsafe(self._resume_pipe)
+
+    def _async_get(self, future, callback):
+        try: chunk = self._pipe_queue.get(False)
+        except Empty:
+            self._async_waiter = (future, callback)
+            return
+        callback(future, chunk)
+
+    def _on_pipe_put(self):
+        if self._async_waiter:
+            waiter = self._async_waiter
+            self._async_waiter = None
+            self._async_get(*waiter)
+
+        if self._pipe_queue.overfull(): self._pause_pipe()
 
 
     @property
     def stdout(self):
-        return "".encode(self.call_args["encoding"]).join(self._stdout)
+        return self._stdout.getvalue()
 
     @property
     def stderr(self):
-        return "".encode(self.call_args["encoding"]).join(self._stderr)
+        return self._stderr.getvalue()
 
 
     def signal(self, sig):
@@ -1109,58 +2536,403 @@ class OProc(object):
         elif os.WIFEXITED(exit_code): return os.WEXITSTATUS(exit_code)
         else: raise RuntimeError("Unknown child exit status!")
 
+    def _reap(self):
+        """ collects the process's exit status and resource usage, if it has
+        exited, without blocking.  returns whether or not it has """
+        with self._reap_lock:
+            if self.exit_code is None and self._reap_error is None:
+                try: pid, exit_code, rusage = os.wait4(self.pid, os.WNOHANG)
+                except OSError as e:
+                    if e.errno == errno.EINTR: return False
+
+                    # no child process.  somebody else reaped it out from
+                    # under us, so we'll never know how it exited
+                    self._reap_error = e
+                    return True
+
+                if pid == self.pid:
+                    self.rusage = rusage
+                    self.exit_code = self._handle_exit_code(exit_code)
+
+            return self.exit_code is not None or self._reap_error is not None
+
     @property
     def alive(self):
-        if self.exit_code is not None: return False
-
-        # what we're doing here essentially is making sure that the main thread
-        # (or another thread), isn't calling .wait() on the process.  because
-        # .wait() calls os.waitpid(self.pid, 0), we can't do an os.waitpid
-        # here...because if we did, and the process exited while in this
-        # thread, the main thread's os.waitpid(self.pid, 0) would raise OSError
-        # (because the process ended in another thread).
-        #
-        # so essentially what we're doing is, using this lock, checking if
-        # we're calling .wait(), and if we are, let .wait() get the exit code
-        # and handle the status, otherwise let us do it.
-        acquired = self._wait_lock.acquire(False)
-        if not acquired:
-            if self.exit_code is not None: return False
-            return True
+        return not self._reap()
+
+
+    def wait(self, timeout=None):
+        """ waits for the process to exit and for all of its output to be
+        read.  returns the exit code, or None if timeout seconds passed before
+        that happened """
+
+        self._read_direct_pipe()
+
+        # if we're being waited on from inside of a callback, we're in the
+        # reactor thread, and nobody else is going to do our io for us
+        if self._reactor.in_thread():
+            self._reactor.run_until(self._io_done.is_set, timeout)
+        else:
+            self._io_done.wait(timeout)
+
+        # python 2.6's Event.wait() doesn't tell us whether it timed out
+        if not self._io_done.is_set(): return None
+
+        if self._input_thread: self._input_thread.join()
+        OProc._procs_to_cleanup.discard(self)
+
+        if self._reap_error: raise self._reap_error
+        return self.exit_code
+
 
-        try:
-            # WNOHANG is just that...we're calling waitpid without hanging...
-            # essentially polling the process
-            pid, exit_code = os.waitpid(self.pid, os.WNOHANG)
-            if pid == self.pid:
-                self.exit_code = self._handle_exit_code(exit_code)
-                return False
 
-        # no child process
-        except OSError: return False
-        else: return True
-        finally: self._wait_lock.release()
 
+# the queue that a process's output is put on, for iterating over it or for
+# piping it into another process.  it can tell whoever is interested when
+# something has been put on it
+class PipeQueue(Queue):
+    def __init__(self, maxbytes=None):
+        Queue.__init__(self)
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._put_listeners = []
+        self._get_listeners = []
 
-    def wait(self):
-        self.log.debug("acquiring wait lock to wait for completion")
-        with self._wait_lock:
-            self.log.debug("got wait lock")
+    def add_put_listener(self, listener):
+        self._put_listeners.append(listener)
 
-            if self.exit_code is None:
-                self.log.debug("exit code not set, waiting on pid")
-                pid, exit_code = os.waitpid(self.pid, 0)
-                self.exit_code = self._handle_exit_code(exit_code)
+    def remove_put_listener(self, listener):
+        try: self._put_listeners.remove(listener)
+        except ValueError: pass
+
+    def add_get_listener(self, listener):
+        self._get_listeners.append(listener)
+
+    def remove_get_listener(self, listener):
+        try: self._get_listeners.remove(listener)
+        except ValueError: pass
+
+    # nbytes is kept up to date under the queue's own lock.  a put never
+    # blocks on it though.  maxbytes is for whoever is putting things on the
+    # queue to check, with overfull(), so that it can stop producing them
+    def _put(self, item):
+        Queue._put(self, item)
+        if item is not None: self.nbytes += len(item)
+
+    def _get(self):
+        item = Queue._get(self)
+        if item is not None: self.nbytes -= len(item)
+        return item
+
+    def overfull(self):
+        return self.maxbytes is not None and self.nbytes >= self.maxbytes
+
+    def drained(self):
+        return self.maxbytes is None or self.nbytes <= self.maxbytes // 2
+
+    def unbound(self):
+        """ lifts maxbytes, for when nothing is going to read the queue any
+        more, so that whoever is waiting for it to drain doesn't wait forever
+        """
+        self.maxbytes = None
+        for listener in list(self._get_listeners): listener()
+
+    def put(self, item, block=True, timeout=None):
+        Queue.put(self, item, block, timeout)
+        for listener in list(self._put_listeners): listener()
+
+    def get(self, block=True, timeout=None):
+        item = Queue.get(self, block, timeout)
+        for listener in list(self._get_listeners): listener()
+        return item
+
+    def get_batch(self, max_items, timeout=None):
+        """ waits for there to be something on the queue, for up to timeout
+        seconds, or forever if it's None, and then takes everything that's
+        there, up to max_items, all at once.  raises Empty on a timeout """
+        self.not_empty.acquire()
+        try:
+            if timeout is None:
+                while not self._qsize(): self.not_empty.wait()
             else:
-                self.log.debug("exit code already set (%d), no need to wait", self.exit_code)
+                deadline = _time.time() + timeout
+                while not self._qsize():
+                    remaining = deadline - _time.time()
+                    if remaining <= 0: raise Empty
+                    self.not_empty.wait(remaining)
+
+            items = []
+            while self._qsize() and len(items) < max_items:
+                items.append(self._get())
+            self.not_full.notify_all()
+        finally:
+            self.not_empty.release()
+
+        for listener in list(self._get_listeners): listener()
+        return items
+
+
+
+# a process's stdin can be any Queue, which we want to hear about things being
+# put on, the way that we do with a PipeQueue.  so a plain Queue gets a put()
+# that tells us, and the methods for listening to it
+def _listenable_queue(queue):
+    if hasattr(queue, "add_put_listener"): return queue
+
+    listeners = []
+    put = queue.put
+    def put_and_notify(item, block=True, timeout=None):
+        put(item, block, timeout)
+        for listener in list(listeners): listener()
+
+    def remove_put_listener(listener):
+        try: listeners.remove(listener)
+        except ValueError: pass
+
+    queue.put = put_and_notify
+    queue.add_put_listener = listeners.append
+    queue.remove_put_listener = remove_put_listener
+    return queue
+
+
+
+# where a process's stdout or stderr is aggregated.  it's one contiguous
+# bytearray, rather than an object per chunk, so a line-buffered process that
+# writes millions of short lines doesn't cost us millions of bytes objects.
+#
+# maxbytes bounds how many bytes we keep, and drop says whether we push off
+# the "oldest" ones or stop keeping the "newest" ones when we go over.
+# maxchunks is internal_bufsize, which counts chunks, not bytes.  for that we
+# only have to remember how long the chunks we're keeping are.
+#
+# with spill, we keep everything, but once there's more than spill bytes of
+# it, it all goes into an unlinked temporary file, and our bytearray is only
+# what hasn't been written there yet.  moving what we already had along with
+# it keeps the output in one piece, so getbuffer() can mmap it
+class CaptureBuffer(object):
+    _spill_write_size = 64 * 1024
+
+    def __init__(self, maxbytes=None, drop="oldest", maxchunks=None,
+            spill=None):
+        if drop not in ("oldest", "newest"):
+            raise ValueError("maxbytes_drop must be \"oldest\" or \"newest\", \
+not %r" % (drop,))
+
+        self.maxbytes = maxbytes
+        self.drop = drop
+        self._data = bytearray()
+        self._exported = False
+
+        # what we've pushed off of the front of _data, but haven't actually
+        # removed from it yet.  whoever reads us from another thread takes
+        # the two of them together
+        self._start = 0
+        self._start_lock = threading.Lock()
+
+        # once we're closed, nothing else gets appended, so getvalue() only
+        # has to put our bytes together once
+        self._closed = False
+        self._value = None
+
+        self.spill = spill
+        self._file = None
+        self._spilled = 0
+        self._mmap = None
+        if spill is not None:
+            self.maxbytes = maxchunks = None
+
+            # the reactor appends, while whoever reads us from another thread
+            # may have to write out what we haven't yet
+            self._spill_lock = threading.Lock()
+
+        # the lengths of the chunks we're keeping, oldest first, starting at
+        # _first.  the oldest one may have been partly pushed off by maxbytes.
+        # an array of ints is 4 bytes a chunk, where a deque would be a
+        # pointer, and an int object for anything but the shortest chunks
+        self._maxchunks = maxchunks
+        self._chunk_lens = None
+        self._first = 0
+        if maxchunks is not None: self._chunk_lens = array("I")
 
-            self._input_thread.join()
-            self._output_thread.join()
+    def __len__(self):
+        if self._value is not None: return len(self._value)
+        return self._spilled + len(self._data) - self._start
 
-            OProc._procs_to_cleanup.discard(self)
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def append(self, chunk):
+        if self.spill is not None:
+            self._spill_append(chunk)
+            return
+
+        maxbytes = self.maxbytes
+        if maxbytes is not None and self.drop == "newest":
+            chunk = chunk[:max(0, maxbytes - len(self))]
+        if not chunk: return
+
+        data = self._writable()
+        data.extend(chunk)
+        kept = len(data) - self._start
+
+        chunk_lens = self._chunk_lens
+        if chunk_lens is None:
+            if maxbytes is not None and kept > maxbytes:
+                self._drop(kept - maxbytes)
+            return
+
+        chunk_lens.append(len(chunk))
+        first = self._first
+        drop = 0
+        while len(chunk_lens) - first > self._maxchunks:
+            drop += chunk_lens[first]
+            first += 1
+
+        if maxbytes is not None:
+            excess = kept - drop - maxbytes
+            while excess > 0 and excess >= chunk_lens[first]:
+                excess -= chunk_lens[first]
+                drop += chunk_lens[first]
+                first += 1
+            if excess > 0:
+                chunk_lens[first] -= excess
+                drop += excess
+
+        # we only shift the chunk lengths down once there's a lot to shift
+        # out, so that it's cheap on average
+        if first > 4096 and first * 2 > len(chunk_lens):
+            del chunk_lens[:first]
+            first = 0
+        self._first = first
+
+        if drop: self._drop(drop)
+
+    # deleting from the front of a bytearray is cheap, but the next time that
+    # it grows, it moves everything that's left back to the front.  so we
+    # only really drop what we've pushed off once it's as much as what we're
+    # keeping, which moves each byte that we keep once, on average
+    def _drop(self, size):
+        start = self._start + size
+        if start * 2 < len(self._data):
+            self._start = start
+            return
+        with self._start_lock:
+            self._data = self._data[start:]
+            self._start = 0
+            self._exported = False
+
+    def _writable(self):
+        # a bytearray can't be resized while there's a memoryview of it, so
+        # whoever has one keeps the old bytearray, and we carry on with a copy
+        if self._exported:
+            with self._start_lock:
+                self._data = self._data[self._start:]
+                self._start = 0
+                self._exported = False
+        return self._data
+
+    def _spill_append(self, chunk):
+        with self._spill_lock:
+            self._writable().extend(chunk)
+
+            if self._file is None:
+                if len(self._data) <= self.spill: return
+                self._file = _tempfile.TemporaryFile()
+
+            if len(self._data) >= self._spill_write_size: self._write_out()
+
+    def _write_out(self):
+        data = self._writable()
+        fd = self._file.fileno()
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:written + 1024 ** 2])
+        self._spilled += written
+        del data[:]
 
-            return self.exit_code
+    def close(self):
+        """ says that nothing more is going to be appended """
+        self._closed = True
+
+    def getvalue(self):
+        if self._value is not None: return self._value
+
+        # spilled output is too big to want to keep in memory, so it's read
+        # back from our file every time it's asked for
+        if self._file is not None: return self._spilled_mmap()[:]
+
+        # we don't need our bytearray anymore, now that there's a copy of it
+        # that we're keeping.  anybody with a view of it keeps it around
+        with self._start_lock: data, start = self._data, self._start
+        value = bytes(data[start:]) if start else bytes(data)
+        if self._closed:
+            self._value = value
+            self._data = bytearray()
+            self._start = 0
+        return value
+
+    def chunks(self, buffer_type, start=0):
+        """ yields what we've kept from start on, in the pieces that a
+        StreamBufferer of buffer_type would cut it into.  if we've spilled,
+        each piece is read from an mmap of our file as it's asked for """
+        if self._file is None:
+            data = self.getvalue()
+        else:
+            data = self._spilled_mmap()
+            if buffer_type == 0: buffer_type = self._spill_write_size
+        return _iter_buffered(data, buffer_type, start)
+
+    def getbuffer(self):
+        """ returns a read-only memoryview of what we've kept, without
+        copying it.  if we've spilled, it's of an mmap of our file, so
+        nothing is read until it's looked at.  python 2 can't make a
+        memoryview of an mmap, so there it's a buffer instead """
+        if self._value is not None: return memoryview(self._value)
+
+        if self._file is None:
+            with self._start_lock:
+                self._exported = True
+                view = memoryview(self._data)[self._start:]
+            if hasattr(view, "toreadonly"): view = view.toreadonly()
+            return view
+
+        if IS_PY3: return memoryview(self._spilled_mmap())
+        else: return buffer(self._spilled_mmap())
+
+    def _spilled_mmap(self):
+        with self._spill_lock:
+            self._write_out()
+
+            # the file only grows, so once we have an mmap of all of it, it's
+            # good until more gets written.  an old one stays open for as long
+            # as somebody has a view of it
+            if self._mmap is None or len(self._mmap) != self._spilled:
+                self._mmap = mmap.mmap(self._file.fileno(), self._spilled,
+                    access=mmap.ACCESS_READ)
+            return self._mmap
+
+
+
+# the read end of a process's stdout pipe, when nothing in python needs to see
+# the process's output.  the process that it's piped into claims it and reads
+# from it directly.  it's closed if nobody ever claims it
+class DirectPipe(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def detach(self):
+        fd = self.fd
+        self.fd = None
+        return fd
 
+    def close(self):
+        fd = self.detach()
+        if fd is not None: os.close(fd)
+
+    def __del__(self):
+        try: self.close()
+        except: pass
 
 
 
@@ -1169,6 +2941,46 @@ class NoStdinData(Exception): pass
 
 
 
+# python 3.3+ can write a lot of chunks with a single syscall.  the kernel only
+# takes so many at a time though
+if hasattr(os, "writev"):
+    _writev = os.writev
+    try: _IOV_MAX = os.sysconf("SC_IOV_MAX")
+    except (ValueError, OSError): _IOV_MAX = -1
+    if _IOV_MAX <= 0: _IOV_MAX = 1024
+else:
+    def _writev(fd, chunks): return os.write(fd, chunks[0])
+    _IOV_MAX = 1
+
+
+
+def _iter_slices(data, size, start=0):
+    for i in range(start, len(data), size): yield data[i:i + size]
+
+# the lines of data, with a newline after the last one, whether or not data
+# ends in one
+def _iter_lines(data):
+    view = _view(data)
+    start = 0
+    while True:
+        end = data.find(b"\n", start)
+        if end == -1: break
+        yield view[start:end + 1]
+        start = end + 1
+    yield data[start:] + b"\n"
+
+# data in the pieces that a StreamBufferer of buffer_type would cut it into
+def _iter_buffered(data, buffer_type, start=0):
+    if buffer_type == 1:
+        while start < len(data):
+            end = data.find(b"\n", start) + 1 or len(data)
+            yield data[start:end]
+            start = end
+    elif buffer_type > 1:
+        for chunk in _iter_slices(data, buffer_type, start): yield chunk
+    elif len(data) > start: yield data[start:]
+
+
 # this guy is for reading from some input (the stream) and writing to our
 # opened process's stdin fd.  the stream can be a Queue, a callable, something
 # with the "read" method, a string, or an iterable
@@ -1178,8 +2990,9 @@ class StreamWriter(object):
         self.process = weakref.ref(process)
         self.stream = stream
         self.stdin = stdin
+        self.closed = False
 
-        self.log = Logger("streamwriter", repr(self))
+        self.log = Logger("streamwriter", self.__repr__)
 
 
         self.stream_bufferer = StreamBufferer(self.process().call_args["encoding"],
@@ -1190,37 +3003,86 @@ class StreamWriter(object):
         elif bufsize == 0: self.bufsize = 1
         else: self.bufsize = bufsize
 
-
-        if isinstance(stdin, Queue):
+        # chunks that have been read from our input but haven't made it into
+        # the process yet, because its stdin fd couldn't take them
+        self.pending = deque()
+        self._done_reading = False
+
+        # whether the last write() ran out of things to write, as opposed to
+        # the process not taking any more, or it having written enough for
+        # now.  whoever has more for us then calls wakeup(), which our process
+        # sets, to have the reactor start writing again
+        self.starved = False
+        self.wakeup = None
+        self._feed_ready = threading.Condition()
+        self._fed = 0
+
+        # strings and bytes are already sliced up into the chunks that we
+        # want, so they skip the bufferer
+        self._prechunked = False
+
+        # whether or not getting a chunk from our input might block.  if it
+        # can't, the reactor can feed the process directly, otherwise we need
+        # a thread of our own
+        self.blocking_source = False
+
+        self._queue_source = isinstance(stdin, Queue)
+        if self._queue_source:
             log_msg = "queue"
             self.get_chunk = self.get_queue_chunk
 
+            # we're told when something is put on the queue, rather than
+            # checking on it
+            self.stdin = _listenable_queue(stdin)
+            self.stdin.add_put_listener(self._on_put)
+
         elif callable(stdin):
             log_msg = "callable"
             self.get_chunk = self.get_callable_chunk
+            self.blocking_source = True
 
         # also handles stringio
         elif hasattr(stdin, "read"):
             log_msg = "file descriptor"
             self.get_chunk = self.get_file_chunk
+            self.blocking_source = True
 
-        elif isinstance(stdin, basestring):
+        # we encode a string once, and then hand out slices of it, and of
+        # bytes, as we go, without copying any of it
+        elif isinstance(stdin, basestring) or isinstance(stdin, _bytes_types):
             log_msg = "string"
 
+            if not isinstance(stdin, _bytes_types):
+                stdin = stdin.encode(self.process().call_args["encoding"])
+
+            # a memoryview can't be searched for newlines
             if bufsize == 1:
-                # TODO, make the split() be a generator
-                self.stdin = iter((c + "\n" for c in stdin.split("\n")))
+                if not isinstance(stdin, (bytes, bytearray)):
+                    stdin = stdin.tobytes()
+                self.stdin = _iter_lines(stdin)
+            # it's all here already, so there's nothing to be gained by
+            # slicing it any smaller than what we write at a time, whatever
+            # the buffering
             else:
-                self.stdin = iter(stdin[i:i + self.bufsize] for i in range(0, len(stdin), self.bufsize))
+                data = _view(stdin)
+                if IS_PY3 and data.format != "B": data = data.cast("B")
+                self.stdin = _iter_slices(data,
+                    max(self.bufsize, self._write_budget))
             self.get_chunk = self.get_iter_chunk
+            self._prechunked = True
 
         else:
             log_msg = "general iterable"
+            self.blocking_source = not isinstance(stdin, (list, tuple))
             self.stdin = iter(stdin)
             self.get_chunk = self.get_iter_chunk
 
         self.log.debug("parsed stdin as a %s", log_msg)
 
+        # the reactor doesn't start out writing for an input thread, it waits
+        # to be told that there's something to write
+        self.starved = self.blocking_source
+
 
     def __repr__(self):
         return "<StreamWriter %s for %r>" % (self.name, self.process())
@@ -1228,8 +3090,15 @@ class StreamWriter(object):
     def fileno(self):
         return self.stream
 
+    # this is called from whichever thread put something on our queue
+    def _on_put(self):
+        with self._feed_ready:
+            starved = self.starved
+            self.starved = False
+        if starved: self.wakeup()
+
     def get_queue_chunk(self):
-        try: chunk = self.stdin.get(True, 0.01)
+        try: chunk = self.stdin.get(False)
         except Empty: raise NoStdinData
         if chunk is None: raise DoneReadingStdin
         return chunk
@@ -1251,48 +3120,164 @@ class StreamWriter(object):
         else: return chunk
 
 
-    # the return value answers the questions "are we done writing forever?"
-    def write(self):
+    def _read_input(self):
+        """ reads a chunk from our input onto pending, returning its size """
         # get_chunk may sometimes return bytes, and sometimes returns trings
         # because of the nature of the different types of STDIN objects we
         # support
-        try: chunk = self.get_chunk()
-        except DoneReadingStdin:
-            self.log.debug("done reading")
+        try:
+            chunk = self.get_chunk()
+            if self._prechunked:
+                self.pending.append(chunk)
+                return len(chunk)
 
-            if self.process().call_args["tty_in"]:
-                # EOF time
-                try: char = termios.tcgetattr(self.stream)[6][termios.VEOF]
-                except: char = chr(4).encode()
-                os.write(self.stream, char)
+            # if we're not bytes, make us bytes
+            if IS_PY3 and hasattr(chunk, "encode"):
+                chunk = chunk.encode(self.process().call_args["encoding"])
 
-            return True
+            size = len(chunk)
+            self.pending.extend(self.stream_bufferer.process(chunk))
+            return size
 
-        except NoStdinData:
-            self.log.debug("received no data")
-            return False
+        except DoneReadingStdin: self.log.debug("done reading")
+        except NoStdinData: raise
 
-        # if we're not bytes, make us bytes
-        if IS_PY3 and hasattr(chunk, "encode"):
-            chunk = chunk.encode(self.process().call_args["encoding"])
+        # something that we can't write, like a number, or None from a
+        # callable, is the end of our input.  otherwise it would be tried
+        # again, and fail again, forever
+        except Exception: traceback.print_exc()
 
-        for chunk in self.stream_bufferer.process(chunk):
-            self.log.debug("got chunk size %d: %r", len(chunk), chunk[:30])
+        chunk = self.stream_bufferer.flush()
+        if chunk: self.pending.append(chunk)
+
+        if self.process().call_args["tty_in"]:
+            # EOF time
+            try: char = termios.tcgetattr(self.stream)[6][termios.VEOF]
+            except: char = chr(4).encode()
+            self.pending.append(char)
+
+        # last, because with an input thread, the reactor may be looking
+        # at this as soon as we set it
+        self._done_reading = True
+        return 0
+
+
+    # an input that may block when we ask it for something is read from in a
+    # thread of its own, which hands what it reads off to the reactor to
+    # write.  it only has to wake the reactor up when the reactor has run out
+    # of things to write.  it stops reading while the process is behind on
+    # taking it, so that we don't read everything in while the process is busy
+    _feed_high = 256 * 1024
+
+    def feed(self):
+        """ reads our input until there's no more of it, or until we've been
+        closed, calling wakeup() whenever there's something new for the
+        reactor to write """
+        wakeup = self.wakeup
+        while True:
+            with self._feed_ready:
+                while not self.closed and self._fed >= self._feed_high:
+                    self._feed_ready.wait()
+                if self.closed: return
+
+            # one wakeup is all that the reactor needs, however much more we
+            # read before it gets to writing
+            size = self._read_input()
+            with self._feed_ready:
+                self._fed += size
+                starved = self.starved
+                self.starved = False
+            if starved or self._done_reading: wakeup()
+            if self._done_reading: return
+
+
+    # the chunks at the front of pending, up to budget bytes, reading more from
+    # our input for as long as it has more for us right now.  we never wait
+    # for more though, so putting chunks together like this costs whatever's
+    # waiting to be written no time at all
+    def _gather(self, budget):
+        chunks = []
+        size = 0
+        while size < budget and len(chunks) < _IOV_MAX:
+            if len(chunks) == len(self.pending):
+                # an input thread reads from our input, not us
+                if self.blocking_source or self._done_reading: break
+                try: self._read_input()
+                except NoStdinData:
+                    self.log.debug("received no data")
+                    break
+                continue
+
+            chunk = self.pending[len(chunks)]
+            chunks.append(chunk)
+            size += len(chunk)
+        return chunks
+
+
+    # so that an input that never runs dry (a huge string, say) doesn't
+    # monopolize the reactor, this is the most that we write at a time
+    _write_budget = 64 * 1024
+
+    # the return value answers the questions "are we done writing forever?".
+    # we write until the process's stdin can't take any more (if it's
+    # non-blocking), or until our input has nothing more for us right now, and
+    # either way we keep whatever hasn't been written yet for the next time.
+    # all of the chunks that we have are written with a single writev()
+    def write(self):
+        budget = self._write_budget
+        self.starved = False
+
+        while budget > 0:
+            chunks = self._gather(budget)
+            if not chunks:
+                if self._done_reading: return True
+
+                # whoever gives us more input (an input thread, or someone
+                # putting something on our queue) looks at whether we're
+                # starved, under the same lock, to decide whether it has to
+                # wake us up
+                with self._feed_ready:
+                    if self.pending: continue
+                    if self._queue_source and self.stdin.qsize(): continue
+                    self.starved = True
+                return False
 
-            self.log.debug("writing chunk to process")
-            try:
-                os.write(self.stream, chunk)
-            except OSError:
+            try: written = _writev(self.stream, chunks)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK): return False
                 self.log.debug("OSError writing stdin chunk")
                 return True
 
+            # whatever didn't make it in is written next time, from where we
+            # left off, without copying it
+            budget -= max(written, 1)
+            if self.blocking_source: self._wake_feeder(written)
+            for chunk in chunks:
+                if written < len(chunk):
+                    self.pending[0] = _view(chunk)[written:]
+                    break
+                written -= len(chunk)
+                self.pending.popleft()
+
+        return False
+
+    def _wake_feeder(self, written=0):
+        with self._feed_ready:
+            self._fed -= written
+            self._feed_ready.notify()
+
 
     def close(self):
-        self.log.debug("closing, but flushing first")
-        chunk = self.stream_bufferer.flush()
-        self.log.debug("got chunk size %d to flush: %r", len(chunk), chunk[:30])
+        self.closed = True
+        if self.blocking_source: self._wake_feeder()
+        if self._queue_source:
+            self.stdin.remove_put_listener(self._on_put)
+
+            # the process feeding another's pipe queue to us may be waiting
+            # for us to take more of it, which we never will now
+            unbound = getattr(self.stdin, "unbound", None)
+            if unbound and not self._done_reading: unbound()
         try:
-            if chunk: os.write(self.stream, chunk)
             if not self.process().call_args["tty_in"]:
                 self.log.debug("we used a TTY, so closing the stream")
                 os.close(self.stream)
@@ -1300,6 +3285,115 @@ class StreamWriter(object):
 
 
 
+# how many arguments a callback takes, not counting self, keyed by the
+# function underneath it.  inspect is slow enough at working that out that we
+# don't want to do it for every process that the callback is given to
+_callback_num_args_cache = weakref.WeakKeyDictionary()
+
+# getargspec is all that python 2 has, and python 3.11 doesn't have it at all
+_getargspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec
+
+def _callback_num_args(handler):
+    # a builtin, like list.append, can't tell python 2 what arguments it
+    # takes.  the ones that make any sense as a callback take the data
+    if inspect.isbuiltin(handler): return 1
+
+    implied_arg = 0
+    if inspect.ismethod(handler):
+        implied_arg = 1
+        fn = handler
+
+    elif inspect.isfunction(handler): fn = handler
+
+    # is an object instance with __call__ method
+    else:
+        implied_arg = 1
+        fn = handler.__call__
+
+    # a bound method is a new object every time we see it, but the function
+    # it's bound to isn't.  builtins can't be weakly referenced, so those just
+    # don't get cached
+    key = getattr(fn, "__func__", fn)
+    try: return _callback_num_args_cache[key]
+    except (KeyError, TypeError): pass
+
+    num_args = len(_getargspec(fn).args) - implied_arg
+    try: _callback_num_args_cache[key] = num_args
+    except TypeError: pass
+    return num_args
+
+
+
+# runs a stream's callbacks, one at a time, and in the order that they were
+# submitted, somewhere other than the reactor's thread, so that a slow callback
+# only ever holds up its own stream.  with an executor, a worker runs whatever
+# has piled up for us by the time it starts, then goes back to the executor,
+# so that a busy stream can't keep a worker to itself.  without one, we start
+# a thread of our own, which waits a little while for more before it exits,
+# so that a chatty process doesn't cost us a thread for every read
+class CallbackDispatcher(object):
+    _thread_linger = 0.1
+
+    def __init__(self, executor=None):
+        self.executor = executor
+        self._lock = threading.Condition()
+        self._pending = deque()
+        self._running = False
+        self._idle_callbacks = []
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self._pending.append((fn, args))
+            if self._running:
+                self._lock.notify()
+                return
+            self._running = True
+
+        if self.executor: self.executor.submit(self._run)
+        else:
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def when_idle(self, callback):
+        """ calls callback, from whichever thread, once everything that's been
+        submitted has run """
+        with self._lock:
+            if self._running:
+                self._idle_callbacks.append(callback)
+                # our thread doesn't need to wait around for more now
+                self._lock.notify()
+                return
+        callback()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                pending = self._pending
+                self._pending = deque()
+
+            for fn, args in pending:
+                try: fn(*args)
+                except Exception: traceback.print_exc()
+
+            with self._lock:
+                if not self._pending and not self.executor \
+                        and not self._idle_callbacks:
+                    self._lock.wait(self._thread_linger)
+
+                if self._pending:
+                    if not self.executor: continue
+                    self.executor.submit(self._run)
+                    return
+
+                self._running = False
+                idle = self._idle_callbacks
+                self._idle_callbacks = []
+            for callback in idle: callback()
+            return
+
+
+
 class StreamReader(object):
     def __init__(self, name, process, stream, handler, buffer, bufsize,
             pipe_queue=None, save_data=True):
@@ -1310,19 +3404,38 @@ class StreamReader(object):
         self.save_data = save_data
         self.encoding = process.call_args["encoding"]
         self.decode_errors = process.call_args["decode_errors"]
+        self.binary = process.call_args["binary"]
 
         self.pipe_queue = None
         if pipe_queue: self.pipe_queue = weakref.ref(pipe_queue)
 
-        self.log = Logger("streamreader", repr(self))
+        self.log = Logger("streamreader", self.__repr__)
+
+        # binary output has no lines, so line buffering means unbuffered,
+        # and whatever the buffering, we read as much as we can at a time
+        if self.binary and bufsize == 1: bufsize = 0
 
         self.stream_bufferer = StreamBufferer(self.encoding, bufsize,
             self.decode_errors)
+        self._decoder = codecs.getincrementaldecoder(self.encoding)(
+            self.decode_errors)
 
-        # determine buffering
-        if bufsize == 1: self.bufsize = 1024
+        # determine buffering.  this is the smallest that our reads get.
+        # unbuffered output is always read a byte at a time, so that every
+        # byte gets to whoever's waiting for it as it comes in
+        if self.binary: self.bufsize = BINARY_READ_SIZE
+        elif bufsize == 1: self.bufsize = 1024
         elif bufsize == 0: self.bufsize = 1
         else: self.bufsize = bufsize
+        self.read_size = self.bufsize
+        self.max_read_size = max(MAX_READ_SIZE, self.bufsize)
+        if bufsize == 0 and not self.binary: self.max_read_size = 1
+
+        # we read until there's nothing left, so we can't block when there
+        # isn't.  someone waiting on a full pipe queue can set this to have us
+        # stop reading, until they unset it and we're woken up again
+        _set_nonblocking(stream)
+        self.paused = False
 
 
         # here we're determining the handler type by doing some basic checks
@@ -1345,27 +3458,28 @@ class StreamReader(object):
         # advanced, they may want to terminate the process, or pass some stdin
         # back, and will realize that they can pass a callback of more args
         if self.handler_type == "fn":
-            implied_arg = 0
-            if inspect.ismethod(handler):
-                implied_arg = 1
-                num_args = len(inspect.getargspec(handler).args)
-
-            else:
-                if inspect.isfunction(handler):
-                    num_args = len(inspect.getargspec(handler).args)
-
-                # is an object instance with __call__ method
-                else:
-                    implied_arg = 1
-                    num_args = len(inspect.getargspec(handler.__call__).args)
-
+            num_args = _callback_num_args(handler)
 
             self.handler_args = ()
-            if num_args == implied_arg + 2:
+            if num_args == 2:
                 self.handler_args = (self.process().stdin,)
-            elif num_args == implied_arg + 3:
+            elif num_args == 3:
                 self.handler_args = (self.process().stdin, self.process)
 
+        # with _callback_batch, the callback gets a list of every chunk from
+        # one wakeup, instead of being called for each of them
+        self.batch = None
+        if self.handler_type == "fn" and process.call_args["callback_batch"]:
+            self.batch = []
+
+        # callbacks are never run in the reactor's thread, where one that
+        # takes its time would hold up the io of every other process
+        self.dispatcher = None
+        self._dispatching = []
+        if self.handler_type == "fn":
+            self.dispatcher = CallbackDispatcher(
+                process.call_args["callback_executor"])
+
 
     def fileno(self):
         return self.stream
@@ -1378,6 +3492,8 @@ class StreamReader(object):
         self.log.debug("got chunk size %d to flush: %r",
             len(chunk), chunk[:30])
         if chunk: self.write_chunk(chunk)
+        if self.batch: self._flush_batch()
+        if self._dispatching: self._dispatch()
 
         if self.handler_type == "fd" and hasattr(self.handler, "close"):
             self.handler.flush()
@@ -1387,31 +3503,64 @@ class StreamReader(object):
         except OSError: pass
 
 
+    def _flush_batch(self):
+        batch = self.batch
+        self.batch = []
+        if not self.should_quit: self._call_handler(batch)
+
+    def _call_handler(self, data):
+        # this is really ugly, but we can't store self.process as one of
+        # the handler args in self.handler_args, the reason being is that
+        # it would create cyclic references, and prevent objects from
+        # being garbage collected.  so we're determining if this handler
+        # even requires self.process (by the argument count), and if it
+        # does, resolving the weakref to a hard reference and passing
+        # that into the handler
+        handler_args = self.handler_args
+        if len(self.handler_args) == 2:
+            handler_args = (self.handler_args[0], self.process())
+
+        if self.dispatcher: self._dispatching.append((data, handler_args))
+        else: self.should_quit = self.handler(data, *handler_args)
+
+    # the calls from one wakeup go to the dispatcher all at once, so that
+    # handing them over doesn't cost us more than the calls themselves
+    def _dispatch(self):
+        calls = self._dispatching
+        self._dispatching = []
+        self.dispatcher.submit(self._run_handler, calls)
+
+    # this is how the handler gets called by the dispatcher.  once it's asked
+    # to quit, whatever was already on its way to it gets dropped
+    def _run_handler(self, calls):
+        for data, handler_args in calls:
+            if self.should_quit: return
+            try: self.should_quit = self.handler(data, *handler_args)
+            except Exception: traceback.print_exc()
+
+
     def write_chunk(self, chunk):
         # in PY3, the chunk coming in will be bytes, so keep that in mind
 
         if self.handler_type == "fn" and not self.should_quit:
             # try to use the encoding first, if that doesn't work, send
-            # the bytes, because it might be binary
-            try:
-                to_handler = chunk.decode(self.encoding, self.decode_errors)
-            except UnicodeDecodeError:
-                to_handler = chunk
-
-            # this is really ugly, but we can't store self.process as one of
-            # the handler args in self.handler_args, the reason being is that
-            # it would create cyclic references, and prevent objects from
-            # being garbage collected.  so we're determining if this handler
-            # even requires self.process (by the argument count), and if it
-            # does, resolving the weakref to a hard reference and passing
-            # that into the handler
-            handler_args = self.handler_args
-            if len(self.handler_args) == 2:
-                handler_args = (self.handler_args[0], self.process())
-            self.should_quit = self.handler(to_handler, *handler_args)
+            # the bytes, because it might be binary.  unless we're line
+            # buffered, a chunk can end partway through a character, which
+            # the decoder holds onto until the next one
+            if self.binary: to_handler = chunk
+            else:
+                try:
+                    to_handler = self._decoder.decode(chunk)
+                except UnicodeDecodeError:
+                    self._decoder.reset()
+                    to_handler = chunk
+
+            if not to_handler: pass
+            elif self.batch is not None: self.batch.append(to_handler)
+            else: self._call_handler(to_handler)
 
         elif self.handler_type == "stringio":
-            self.handler.write(chunk.decode(self.encoding, self.decode_errors))
+            self.handler.write(self._decoder.decode(chunk))
 
         elif self.handler_type in ("cstringio", "fd"):
             self.handler.write(chunk)
@@ -1428,20 +3577,55 @@ class StreamReader(object):
                 self.pipe_queue().put(chunk)
 
 
+    # every time we're woken up, we read until there's nothing left, or until
+    # we've done this many reads, so that one busy process can't keep the
+    # reactor from everything else
+    _reads_per_wakeup = 64
+
     def read(self):
-        # if we're PY3, we're reading bytes, otherwise we're reading
-        # str
-        try: chunk = os.read(self.stream, self.bufsize)
-        except OSError as e:
-            self.log.debug("got errno %d, done reading", e.errno)
-            return True
-        if not chunk:
-            self.log.debug("got no chunk, done reading")
-            return True
+        """ reads whatever is waiting for us, returning True once there's
+        nothing more to read """
+        try: return self._read()
+        finally:
+            if self.batch: self._flush_batch()
+            if self._dispatching: self._dispatch()
+
+    def _read(self):
+        for i in range(self._reads_per_wakeup):
+            if self.paused: return False
+
+            # if we're PY3, we're reading bytes, otherwise we're reading
+            # str
+            try: chunk = os.read(self.stream, self.read_size)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK): return False
+                self.log.debug("got errno %d, done reading", e.errno)
+                return True
+            if not chunk:
+                self.log.debug("got no chunk, done reading")
+                return True
+
+            # a full read means that there's probably a lot more where that
+            # came from, so we ask for more next time.  when there turns out
+            # not to be, we go back down, so that a quiet process doesn't have
+            # us allocating big reads for a few bytes each
+            size = len(chunk)
+            full = size == self.read_size
+            if full:
+                self.read_size = min(self.read_size * 2, self.max_read_size)
+            elif size * 4 < self.read_size:
+                self.read_size = max(self.read_size // 2, self.bufsize)
 
-        self.log.debug("got chunk size %d: %r", len(chunk), chunk[:30])
-        for chunk in self.stream_bufferer.process(chunk):
-            self.write_chunk(chunk)
+            for chunk in self.stream_bufferer.process(chunk):
+                self.write_chunk(chunk)
+
+            # a short read got everything that was there.  asking again, only
+            # to be told that there's nothing, costs us a syscall, and on a
+            # pty, it can lose the output that a process writes just before
+            # it exits
+            if not full: return False
+
+        return False
 
 
 
@@ -1462,6 +3646,15 @@ class StreamBufferer(object):
         self.encoding = encoding
         self.decode_errors = decode_errors
 
+        # we split lines on bytes, without decoding them, which works for any
+        # encoding where a newline byte is only ever a newline (utf8, latin1,
+        # and most others).  the decoder is only for noticing when the data
+        # isn't text at all.  being incremental, it doesn't mistake a
+        # character split across two reads for that
+        self._newline = "\n".encode(encoding)
+        self._bytes_lines = self._newline == b"\n"
+        self._decoder = codecs.getincrementaldecoder(encoding)(decode_errors)
+
         # this is for if we change buffering types.  if we change from line
         # buffered to unbuffered, its very possible that our self.buffer list
         # has data that was being saved up (while we searched for a newline).
@@ -1472,40 +3665,38 @@ class StreamBufferer(object):
         # types from a different thread.  for example, if we have a stdout
         # callback, we might use it to change the way stdin buffers.  so we
         # lock
-        self._buffering_lock = threading.RLock()
+        self._buffering_lock = threading.Lock()
         self.log = Logger("stream_bufferer")
 
 
     def change_buffering(self, new_type):
-        # TODO, when we stop supporting 2.6, make this a with context
-        self.log.debug("acquiring buffering lock for changing buffering")
-        self._buffering_lock.acquire()
-        self.log.debug("got buffering lock for changing buffering")
-        try:
-            if new_type == 0: self._use_up_buffer_first = True
+        self.log.debug("changing buffering to %d", new_type)
+        with self._buffering_lock: self._change_buffering(new_type)
 
-            self.type = new_type
-        finally:
-            self._buffering_lock.release()
-            self.log.debug("released buffering lock for changing buffering")
+    def _change_buffering(self, new_type):
+        if new_type == 0: self._use_up_buffer_first = True
+
+        # the start of a character that we were decoding is part of what
+        # we've saved up
+        if self.type == 1 and not self._bytes_lines:
+            self.buffer.append(self._decoder.getstate()[0])
+            self._decoder.reset()
+
+        self.type = new_type
 
 
     def process(self, chunk):
         # MAKE SURE THAT THE INPUT IS PY3 BYTES
         # THE OUTPUT IS ALWAYS PY3 BYTES
-
-        # TODO, when we stop supporting 2.6, make this a with context
-        self.log.debug("acquiring buffering lock to process chunk (buffering: %d)", self.type)
-        self._buffering_lock.acquire()
-        self.log.debug("got buffering lock to process chunk (buffering: %d)", self.type)
-        try:
+        with self._buffering_lock:
             # we've encountered binary, permanently switch to N size buffering
             # since matching on newline doesn't make sense anymore
             if self.type == 1:
-                try: chunk.decode(self.encoding, self.decode_errors)
-                except:
+                try: text = self._decoder.decode(chunk)
+                except UnicodeDecodeError:
                     self.log.debug("detected binary data, changing buffering")
-                    self.change_buffering(1024)
+                    self._decoder.reset()
+                    self._change_buffering(1024)
 
             # unbuffered
             if self.type == 0:
@@ -1513,6 +3704,7 @@ class StreamBufferer(object):
                     self._use_up_buffer_first = False
                     to_write = self.buffer
                     self.buffer = []
+                    self.n_buffer_count = 0
                     to_write.append(chunk)
                     return to_write
 
@@ -1520,67 +3712,87 @@ class StreamBufferer(object):
 
             # line buffered
             elif self.type == 1:
-                total_to_write = []
-                chunk = chunk.decode(self.encoding, self.decode_errors)
-                while True:
-                    newline = chunk.find("\n")
-                    if newline == -1: break
-
-                    chunk_to_write = chunk[:newline + 1]
-                    if self.buffer:
-                        # this is ugly, but it's designed to take the existing
-                        # bytes buffer, join it together, tack on our latest
-                        # chunk, then convert the whole thing to a string.
-                        # it's necessary, i'm sure.  read the whole block to
-                        # see why.
-                        chunk_to_write = "".encode(self.encoding).join(self.buffer) \
-                            + chunk_to_write.encode(self.encoding)
-                        chunk_to_write = chunk_to_write.decode(self.encoding)
-
-                        self.buffer = []
-                        self.n_buffer_count = 0
-
-                    chunk = chunk[newline + 1:]
-                    total_to_write.append(chunk_to_write.encode(self.encoding))
-
-                if chunk:
-                    self.buffer.append(chunk.encode(self.encoding))
-                    self.n_buffer_count += len(chunk)
-                return total_to_write
+                if self._bytes_lines: return self._split_lines(chunk)
+                return self._split_text_lines(text)
 
             # N size buffered
             else:
-                total_to_write = []
-                while True:
-                    overage = self.n_buffer_count + len(chunk) - self.type
-                    if overage >= 0:
-                        ret = "".encode(self.encoding).join(self.buffer) + chunk
-                        chunk_to_write = ret[:self.type]
-                        chunk = ret[self.type:]
-                        total_to_write.append(chunk_to_write)
-                        self.buffer = []
-                        self.n_buffer_count = 0
-                    else:
-                        self.buffer.append(chunk)
-                        self.n_buffer_count += len(chunk)
-                        break
-                return total_to_write
-        finally:
-            self._buffering_lock.release()
-            self.log.debug("released buffering lock for processing chunk (buffering: %d)", self.type)
+                return self._split_sized(chunk)
+
+
+    def _split_lines(self, chunk):
+        lines = chunk.split(b"\n")
+        rest = lines.pop()
+
+        if lines:
+            lines = [line + b"\n" for line in lines]
+
+            # the first line finishes off whatever we had saved up
+            if self.buffer:
+                self.buffer.append(lines[0])
+                lines[0] = b"".join(self.buffer)
+                self.buffer = []
+                self.n_buffer_count = 0
+
+        if rest:
+            self.buffer.append(rest)
+            self.n_buffer_count += len(rest)
+        return lines
+
+
+    def _split_text_lines(self, text):
+        # for encodings like utf16, where a newline's bytes can show up in
+        # the middle of other characters, we have to find them in the text.
+        # what we save up is whole characters, since the decoder holds onto
+        # the start of a character that's been split
+        if self.buffer:
+            text = b"".join(self.buffer).decode(self.encoding,
+                self.decode_errors) + text
+            self.buffer = []
+            self.n_buffer_count = 0
+
+        lines = text.split("\n")
+        rest = lines.pop()
+
+        if rest:
+            rest = rest.encode(self.encoding)
+            self.buffer.append(rest)
+            self.n_buffer_count = len(rest)
+        return [(line + "\n").encode(self.encoding) for line in lines]
+
+
+    def _split_sized(self, chunk):
+        size = self.type
+        if self.n_buffer_count + len(chunk) < size:
+            self.buffer.append(chunk)
+            self.n_buffer_count += len(chunk)
+            return []
+
+        if self.buffer:
+            self.buffer.append(chunk)
+            chunk = b"".join(self.buffer)
+            self.buffer = []
+            self.n_buffer_count = 0
+
+        end = len(chunk) - len(chunk) % size
+        to_write = [chunk[i:i + size] for i in range(0, end, size)]
+        if end < len(chunk):
+            self.buffer.append(chunk[end:])
+            self.n_buffer_count = len(chunk) - end
+        return to_write
 
 
     def flush(self):
-        self.log.debug("acquiring buffering lock for flushing buffer")
-        self._buffering_lock.acquire()
-        self.log.debug("got buffering lock for flushing buffer")
-        try:
-            ret = "".encode(self.encoding).join(self.buffer)
+        self.log.debug("flushing buffer")
+        with self._buffering_lock:
+            if self.type == 1 and not self._bytes_lines:
+                self.buffer.append(self._decoder.getstate()[0])
+                self._decoder.reset()
+
+            ret = b"".join(self.buffer)
             self.buffer = []
+            self.n_buffer_count = 0
             return ret
-        finally:
-            self._buffering_lock.release()
-            self.log.debug("released buffering lock for flushing buffer")
 
 
 
@@ -6,6 +6,8 @@ import tempfile
 import sys
 import sh
 import platform
+import fcntl
+import mmap
 
 IS_OSX = platform.system() == "Darwin"
 IS_PY3 = sys.version_info[0] == 3
@@ -25,6 +27,7 @@ if not skipUnless:
         return wrapper
 
 requires_posix = skipUnless(os.name == "posix", "Requires POSIX")
+requires_asyncio = skipUnless(sys.version_info >= (3, 5), "Requires async/await")
 requires_utf8 = skipUnless(sh.DEFAULT_ENCODING == "UTF-8", "System encoding must be UTF-8")
 
 
@@ -213,6 +216,32 @@ for l in "andrew":
         self.assertEqual(out, match)
 
 
+    def test_manual_stdin_bad_input(self):
+        from sh import cat
+        import resource
+        import time
+        try: from StringIO import StringIO
+        except ImportError: from io import StringIO
+
+        # input that we can't write is the end of it, reported once, rather
+        # than being tried again every time the process's stdin is writable
+        old_stderr = sys.stderr
+        sys.stderr = err = StringIO()
+        try:
+            self.assertEqual(cat(_in=["a", 1, "b"], _timeout=5), "a")
+            self.assertEqual(cat(_in=lambda: None, _timeout=5), "")
+
+            p = cat(_in=[1, 2], _bg=True)
+            p.wait()
+            used = resource.getrusage(resource.RUSAGE_SELF).ru_utime
+            time.sleep(0.2)
+            used = resource.getrusage(resource.RUSAGE_SELF).ru_utime - used
+        finally:
+            sys.stderr = old_stderr
+        self.assertTrue(used < 0.1)
+        self.assertEqual(err.getvalue().count("Traceback"), 3)
+
+
     def test_manual_stdin_file(self):
         from sh import tr
         import tempfile
@@ -229,6 +258,88 @@ for l in "andrew":
         self.assertEqual(out, test_string.upper())
 
 
+    def test_stdin_fd_passthrough(self):
+        from sh import cat
+        import socket
+
+        py = create_tmp_test("""
+import os
+print(os.readlink("/proc/self/fd/0"))
+""")
+        stdin = tempfile.NamedTemporaryFile()
+        stdin.write(b"first\nsecond\n")
+        stdin.flush()
+        stdin.seek(0)
+
+        # the process reads the file itself
+        out = python(py.name, _in=stdin)
+        self.assertEqual(out.strip(), stdin.name)
+
+        # from wherever the file object is, even if it has read ahead
+        stdin.seek(0)
+        self.assertEqual(stdin.readline(), b"first\n")
+        self.assertEqual(cat(_in=stdin), "second\n")
+
+        left, right = socket.socketpair()
+        left.sendall(b"over a socket")
+        left.close()
+        self.assertEqual(cat(_in=right), "over a socket")
+        right.close()
+
+
+    def test_stdin_bytes(self):
+        from sh import cat
+
+        data = b"\xff\x00\n" * 1024 ** 2
+        for stdin in (data, bytearray(data), memoryview(data)):
+            p = cat(_in=stdin, _binary=True, _in_bufsize=64 * 1024)
+            self.assertEqual(p.stdout, data)
+
+        self.assertEqual(cat(_in=b"one\ntwo", _in_bufsize=1), "one\ntwo\n")
+        text = b"\xc3\xbcn\xc3\xaf\nc\xc3\xb6d\xc3\xa9".decode("utf8")
+        self.assertEqual(cat(_in=text, _in_bufsize=1, _encoding="utf8"),
+            text + "\n")
+
+
+    def test_stdin_coalesced_writes(self):
+        from sh import cat
+
+        # lots of small chunks are written a lot of them at a time, and
+        # whatever doesn't fit is picked up where it left off
+        lines = ["%07d\n" % i for i in range(100000)]
+        expected = "".join(lines)
+        self.assertEqual(cat(_in=lines, _tty_out=False), expected)
+        self.assertEqual(cat(_in=iter(lines), _tty_out=False), expected)
+
+        # unbuffered, a string is still written as much as we can at a time
+        writes = []
+        writev = sh._writev
+        def counting_writev(fd, chunks):
+            writes.append(len(chunks))
+            return writev(fd, chunks)
+
+        sh._writev = counting_writev
+        try: p = cat(_in=expected, _in_bufsize=0, _tty_out=False)
+        finally: sh._writev = writev
+        self.assertEqual(p, expected)
+        self.assertTrue(len(writes) < 100)
+
+
+    def test_stdin_generator_backpressure(self):
+        from sh import sleep
+
+        # the process never reads its stdin, so we only read so far ahead of
+        # it, instead of reading everything in
+        read = [0]
+        def gen():
+            while True:
+                read[0] += 1
+                yield "x" * 1024
+
+        sleep(0.3, _in=gen())
+        self.assertTrue(read[0] < 1000)
+
+
     def test_manual_stdin_queue(self):
         from sh import tr
         try: from Queue import Queue, Empty
@@ -246,6 +357,190 @@ for l in "andrew":
         self.assertEqual(out, match)
 
 
+    def test_stdin_queue_wakeups(self):
+        from sh import cat
+        import time
+        try: from Queue import Queue
+        except ImportError: from queue import Queue
+
+        # what's put on the queue gets to the process right away, instead of
+        # whenever we next check on the queue
+        q = Queue()
+        p = cat(_in=q, _iter=True, _tty_out=False)
+        latencies = []
+        for i in range(20):
+            time.sleep(0.005)
+            started = time.time()
+            q.put("%d\n" % i)
+            self.assertEqual(next(p), "%d\n" % i)
+            latencies.append(time.time() - started)
+        q.put(None)
+        p.wait()
+
+        latencies.sort()
+        self.assertTrue(latencies[len(latencies) // 2] < 0.005)
+
+        # and while it's idle, there's nothing waiting to check on it
+        q = Queue()
+        p = cat(_in=q, _bg=True)
+        time.sleep(0.05)
+        resume = p.process._resume_writing
+        timers = [t for when, seq, t in p.process._reactor._timers
+            if not t.cancelled and t.callback == resume]
+        self.assertEqual(timers, [])
+        q.put("done")
+        q.put(None)
+        self.assertEqual(p, "done")
+
+
+    def test_pipe_maxbytes(self):
+        import time
+        from sh import head, wc
+
+        # nobody is reading from the queue, so we stop reading the process,
+        # rather than putting all 32MB of its output on it
+        p = head("-c", 32 * 1024 ** 2, "/dev/zero", _iter=True,
+            _binary=True, _pipe_maxbytes=256 * 1024)
+        time.sleep(0.3)
+        queue = p.process._pipe_queue
+        self.assertTrue(queue.nbytes < 256 * 1024 + sh.MAX_READ_SIZE)
+        self.assertTrue(p.process.alive)
+
+        # and we pick up where we left off as it's read
+        self.assertEqual(sum(len(chunk) for chunk in p), 32 * 1024 ** 2)
+        self.assertEqual(queue.nbytes, 0)
+
+        # a command piped into another is bounded by default
+        p = head("-c", 32 * 1024 ** 2, "/dev/zero", _piped=True)
+        self.assertEqual(int(wc(p, c=True).strip()), 32 * 1024 ** 2)
+        self.assertEqual(p.process._pipe_queue.maxbytes, sh.PIPE_MAXBYTES)
+
+        # and it doesn't keep all of that in .stdout either, or wait for a
+        # line that never ends
+        self.assertEqual(len(p.stdout), sh.PIPE_MAXBYTES)
+        self.assertEqual(p.process._stdout_stream.stream_bufferer.type, 0)
+        p = head("-c", 32 * 1024 ** 2, "/dev/zero", _piped=True,
+            _out_maxbytes=10)
+        self.assertEqual(int(wc(p, c=True).strip()), 32 * 1024 ** 2)
+        self.assertEqual(len(p.stdout), 10)
+
+        # unless what it's piped into stops reading it, which it mustn't wait
+        # on forever
+        p = head("-c", 32 * 1024 ** 2, "/dev/zero", _piped=True)
+        self.assertEqual(len(head(p, c=10, _binary=True)), 10)
+        p.wait()
+
+
+    def test_pipe_subscribe(self):
+        import time
+        from sh import cat
+
+        py = create_tmp_test("""
+import sys
+import time
+sys.stdout.write("first\\n")
+sys.stdout.flush()
+time.sleep(0.3)
+sys.stdout.write("second\\n")
+""")
+
+        # a command that's piped after it has started gets what it has
+        # already output, followed by the rest of it
+        p = python(py.name, _bg=True)
+        time.sleep(0.15)
+        self.assertEqual(p.process._pipe_queue, None)
+        self.assertEqual(cat(p).wait(), "first\nsecond\n")
+
+        # and one that has finished can still be iterated over
+        p = python(py.name)
+        self.assertEqual(list(p), ["first\n", "second\n"])
+
+
+    def test_done_callback_race(self):
+        from sh import true
+        from functools import partial
+        import time
+
+        # a callback that's added just as the process finishes is still
+        # called, once
+        calls = []
+        for i in range(200):
+            p = true(_bg=True)
+            p.process.add_done_callback(partial(calls.append, i))
+
+        deadline = time.time() + 5
+        while len(calls) < 200 and time.time() < deadline: time.sleep(0.01)
+        self.assertEqual(sorted(calls), list(range(200)))
+
+
+    def test_parallel(self):
+        import time
+        from sh import ErrorReturnCode
+
+        py = create_tmp_test("""
+import sys
+import time
+time.sleep(float(sys.argv[1]))
+print(sys.argv[1])
+exit(sys.argv[2:] == ["fail"])
+""")
+        job = python.bake(py.name)
+        delays = ["0.3", "0.1", "0.2"]
+
+        # as they finish, all running at once
+        started = time.time()
+        results = list(sh.parallel(job, delays, jobs=3))
+        self.assertTrue(time.time() - started < 0.5)
+        self.assertEqual([item for item, p in results], ["0.1", "0.2", "0.3"])
+        self.assertEqual([p.strip() for item, p in results],
+            ["0.1", "0.2", "0.3"])
+
+        # or in the order that they were given, one at a time
+        started = time.time()
+        results = list(sh.parallel(job, delays, jobs=1, ordered=True))
+        self.assertTrue(time.time() - started >= 0.6)
+        self.assertEqual([item for item, p in results], delays)
+
+        # with the arguments made from each item.  in order, a failure that
+        # finishes first still waits for its turn to be raised
+        results = sh.parallel(job, [("0.2", "ok"), ("0", "fail")],
+            template=("{0}", "{1}"), jobs=2, ordered=True)
+        self.assertEqual(next(results)[1].strip(), "0.2")
+        self.assertRaises(ErrorReturnCode, next, results)
+
+        # or with the failures given back, instead of stopping at them
+        results = list(sh.parallel(job, [("0", "fail"), ("0",)], jobs=2,
+            ordered=True, fail_fast=False))
+        self.assertTrue(isinstance(results[0][1], ErrorReturnCode))
+        self.assertEqual(results[1][1].strip(), "0")
+
+        # inputs are only taken as there's room to run them
+        taken = []
+        def inputs():
+            for i in range(1000):
+                taken.append(i)
+                yield "0"
+        results = sh.parallel(job, inputs(), jobs=2)
+        next(results)
+        self.assertTrue(len(taken) <= 3)
+        results.close()
+
+        # the parallel program is still there, for whoever wants it
+        import shutil
+        bin_dir = tempfile.mkdtemp()
+        old_path = os.environ["PATH"]
+        os.environ["PATH"] = bin_dir + os.pathsep + old_path
+        try:
+            exe = os.path.join(bin_dir, "parallel")
+            with open(exe, "w") as h: h.write("#!/bin/sh\necho program $1\n")
+            os.chmod(exe, 0o755)
+            self.assertEqual(sh.parallel_("x").strip(), "program x")
+            self.assertEqual(sh.Command("parallel")("x").strip(), "program x")
+        finally:
+            os.environ["PATH"] = old_path
+            shutil.rmtree(bin_dir)
+
+
     def test_environment(self):
         import os
 
@@ -283,6 +578,55 @@ print(sh.HERP + " " + str(len(os.environ)))
         self.assertEqual(which("ls"), str(ls))
 
 
+    def test_which_cache(self):
+        import sh
+        import time
+        import shutil
+
+        bin_dir = tempfile.mkdtemp()
+        old_path = os.environ["PATH"]
+        os.environ["PATH"] = bin_dir + os.pathsep + old_path
+        try:
+            prog = "sh_which_cache_test"
+            self.assertEqual(sh.which(prog), None)
+
+            # we're cached now, both ways
+            ls = sh.which("ls")
+            hits = sh.which.cache_info()["hits"]
+            self.assertEqual(sh.which(prog), None)
+            self.assertEqual(sh.which("ls"), ls)
+            self.assertEqual(sh.which.cache_info()["hits"], hits + 2)
+
+            # adding the program modifies its directory, which makes the
+            # cached miss stale
+            time.sleep(0.01)
+            exe = os.path.join(bin_dir, prog)
+            with open(exe, "w") as h: h.write("#!/bin/sh\necho found\n")
+            os.chmod(exe, 0o755)
+            self.assertEqual(sh.which(prog), exe)
+            self.assertEqual(sh.Command(prog)().strip(), "found")
+
+            time.sleep(0.01)
+            os.unlink(exe)
+            self.assertEqual(sh.which(prog), None)
+
+            # making a file executable doesn't modify its directory, so a
+            # file that isn't executable yet isn't cached as a miss
+            time.sleep(0.01)
+            with open(exe, "w") as h: h.write("#!/bin/sh\necho found\n")
+            self.assertEqual(sh.which(prog), None)
+            os.chmod(exe, 0o755)
+            self.assertEqual(sh.which(prog), exe)
+            self.assertEqual(sh.Command(prog)().strip(), "found")
+
+            # and a found program that isn't executable any more isn't found
+            os.chmod(exe, 0o644)
+            self.assertEqual(sh.which(prog), None)
+        finally:
+            os.environ["PATH"] = old_path
+            shutil.rmtree(bin_dir)
+
+
     def test_foreground(self):
         return
         raise NotImplementedError
@@ -399,6 +743,49 @@ print(options.long_option)
             with open("/tmp/fail", "a") as h: h.write("FUCK\n")
         self.assertEqual(c1, c2)
 
+    def test_direct_composition(self):
+        from sh import wc, tr
+        py = create_tmp_test("""
+import sys
+sys.stdout.write(str(sys.stdout.isatty()) + "\\n")
+sys.stdout.write("x" * 1000000)
+""")
+        # the data goes straight from one process to the next, without us
+        # seeing it
+        p1 = python(py.name, _piped="direct")
+        p2 = tr(p1, "x", "y", _piped="direct")
+        out = wc(p2, c=True)
+        self.assertEqual(int(out.strip()), len("False\n") + 1000000)
+        p1.wait()
+        self.assertEqual(p1.stdout, b"")
+
+        # if we end up waiting on it before anything claims it, we read it
+        # ourselves, so that the process can finish, and the data still gets
+        # piped on later
+        p1 = python(py.name, _piped="direct")
+        p1.wait()
+        out = tr(p1, "x", "y")
+        self.assertEqual(out, "False\n" + "y" * 1000000)
+
+        # something that it started may still have the pipe open after it
+        # has finished, which mustn't hold up everything else while we read
+        import time
+        py = create_tmp_test("""
+import os, sys, time
+sys.stdout.write("hi\\n")
+sys.stdout.flush()
+if os.fork() == 0: time.sleep(1)
+""")
+        p1 = python(py.name, _piped="direct", _bg=True, _err=os.devnull)
+        deadline = time.time() + 5
+        while not p1.process._io_done.is_set() and time.time() < deadline:
+            time.sleep(0.01)
+        p1.wait()
+        start = time.time()
+        python("-c", "pass")
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(tr(p1, "a-z", "A-Z"), "HI\n")
+
 
     def test_short_option(self):
         from sh import sh
@@ -638,6 +1025,43 @@ sys.stderr.write("stderr")
       self.assertTrue(stdout == "stdout")
       self.assertTrue(stderr == "stderr")
 
+
+    def test_direct_fd_redirection(self):
+        import socket
+
+        py = create_tmp_test("""
+import sys, os
+sys.stdout.write(str(os.isatty(1)) + " " + os.readlink("/proc/self/fd/1"))
+sys.stderr.write(os.readlink("/proc/self/fd/2"))
+""")
+        # the process writes to the file itself, after anything we've written
+        out_file = tempfile.NamedTemporaryFile()
+        err_file = tempfile.NamedTemporaryFile()
+        out_file.write(b"before ")
+        p = python(py.name, _out=out_file, _err=err_file.name, _tty_out=False)
+
+        out_file.seek(0)
+        self.assertEqual(out_file.read().decode(),
+            "before False " + out_file.name)
+        err_file.seek(0)
+        self.assertEqual(err_file.read().decode(), err_file.name)
+        self.assertEqual(p.stdout, b"")
+        self.assertEqual(p.stderr, b"")
+
+        # anything with a working fileno()
+        left, right = socket.socketpair()
+        python("-c", "print('hi')", _out=right, _tty_out=False)
+        right.close()
+        self.assertEqual(left.recv(100), b"hi\n")
+        left.close()
+
+        # with _tee, we still see the output
+        out_file = tempfile.NamedTemporaryFile()
+        p = python(py.name, _out=out_file, _tee=True, _tty_out=False)
+        out_file.seek(0)
+        self.assertEqual(out_file.read(), p.stdout)
+        self.assertTrue(p.stdout.startswith(b"False pipe:"))
+
     def test_subcommand_and_bake(self):
         from sh import ls
         import getpass
@@ -680,6 +1104,26 @@ subprocess.Popen(sys.argv[1:], shell=False).wait()
         ft = ran.index("-h")
         self.assertTrue("-la" in ran[ft:])
 
+    def test_baked_call_args(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write(str(sys.stdout.isatty()))
+""")
+        cmd = python.bake(py.name, _tty_out=False)
+
+        # the baked special kwargs stick around for every call, and can be
+        # overridden per call
+        self.assertEqual(str(cmd()), "False")
+        self.assertEqual(str(cmd()), "False")
+        self.assertEqual(str(cmd(_tty_out=True)), "True")
+        self.assertEqual(str(cmd()), "False")
+
+        # incompatible special kwargs baked in different places still get
+        # caught when we're called
+        bad = cmd.bake(_piped=True).bake(_iter=True)
+        self.assertRaises(TypeError, bad)
+        self.assertRaises(TypeError, cmd.bake(_piped=True), _iter=True)
+
     def test_output_equivalence(self):
         from sh import whoami
 
@@ -895,6 +1339,94 @@ for i in range(5):
         self.assertTrue("4" not in p)
         self.assertTrue("4" not in stdout)
 
+
+    def test_stdout_callback_batch(self):
+        from sh import seq
+
+        batches = []
+        def agg(lines, stdin, process): batches.append(lines)
+
+        seq(10000, _out=agg, _callback_batch=True, _tty_out=False).wait()
+        self.assertTrue(len(batches) < 10000)
+        self.assertTrue(all(isinstance(b, list) and b for b in batches))
+        lines = [line for batch in batches for line in batch]
+        self.assertEqual(lines, ["%d\n" % i for i in range(1, 10001)])
+
+
+    @skipUnless(sys.version_info >= (3, 2), "Requires concurrent.futures")
+    def test_stdout_callback_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from sh import seq
+        import threading
+        import time
+
+        executor = ThreadPoolExecutor(4)
+        threads = set()
+        stdout = []
+        def agg(line):
+            threads.add(threading.current_thread())
+            time.sleep(0.0001)
+            stdout.append(line)
+            if line == "500\n": return True
+
+        # every line has made it to the callback, in order, once we're done
+        seq(1000, _out=agg, _callback_executor=executor,
+            _tty_out=False).wait()
+        self.assertEqual(stdout, ["%d\n" % i for i in range(1, 501)])
+        self.assertTrue(threading.current_thread() not in threads)
+
+        lines = []
+        seq(1000, _out=lambda batch: lines.extend(batch),
+            _callback_executor=executor, _callback_batch=True,
+            _tty_out=False).wait()
+        self.assertEqual(lines, ["%d\n" % i for i in range(1, 1001)])
+        executor.shutdown()
+
+
+    def test_slow_callback_isolated(self):
+        from sh import echo, seq
+        import threading
+        import time
+
+        # a callback that blocks holds up its own stream, but not the io of
+        # any other process, and it isn't run in the reactor's thread
+        threads = set()
+        release = threading.Event()
+        def stuck(line):
+            threads.add(threading.current_thread())
+            release.wait(5)
+
+        p = seq(3, _out=stuck)
+        time.sleep(0.1)
+        started = time.time()
+        self.assertEqual(echo("hi"), "hi\n")
+        self.assertTrue(time.time() - started < 0.5)
+        self.assertTrue(sh.Reactor.get()._thread not in threads)
+
+        # and we still aren't done until it's had all of our output
+        release.set()
+        p.wait()
+        self.assertEqual(len(threads), 1)
+
+
+    def test_callback_num_args_cached(self):
+        from sh import _callback_num_args, _callback_num_args_cache
+
+        class Agg(object):
+            def method(self, line, stdin): pass
+            def __call__(self, line, stdin, process): pass
+
+        def fn(line): pass
+
+        agg = Agg()
+        self.assertEqual(_callback_num_args(fn), 1)
+        self.assertEqual(_callback_num_args(agg.method), 2)
+        self.assertEqual(_callback_num_args(agg), 3)
+        self.assertEqual(_callback_num_args_cache[Agg.__call__ if IS_PY3
+            else Agg.__call__.__func__], 3)
+        self.assertTrue(fn in _callback_num_args_cache)
+
+
     def test_general_signal(self):
         import signal
         from signal import SIGINT
@@ -961,6 +1493,55 @@ time.sleep(3)
         self.assertEqual(line, EWOULDBLOCK)
 
 
+    def test_iter_batch(self):
+        py = create_tmp_test("""
+import sys, time
+for i in range(100): print(i)
+sys.stdout.flush()
+time.sleep(0.3)
+print("last")
+""")
+        batches = []
+        for batch in python(py.name, _iter_batch=(30, 0.1), _tty_out=False):
+            batches.append(batch)
+        self.assertTrue(all(isinstance(b, list) for b in batches))
+        self.assertTrue(all(len(b) <= 30 for b in batches))
+        lines = [line for batch in batches for line in batch]
+        self.assertEqual(lines, ["%d\n" % i for i in range(100)] + ["last\n"])
+
+        # the last line came along long after the rest, so it's on its own
+        self.assertEqual(batches[-1], ["last\n"])
+
+        lines = 0
+        for batch in python(py.name, _iter_batch=True, _tty_out=False):
+            lines += len(batch)
+        self.assertEqual(lines, 101)
+
+
+    def test_blocking_iter_interruptible(self):
+        import signal
+        import time
+        from sh import sleep
+
+        # we block on the pipe until there's output, but a signal (like a
+        # ctrl-c) still gets through
+        class Interrupted(Exception): pass
+        def handler(*args): raise Interrupted
+
+        old_handler = signal.signal(signal.SIGALRM, handler)
+        p = sleep(3, _iter=True)
+        started = time.time()
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.2)
+            self.assertRaises(Interrupted, next, p)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+            p.kill()
+
+        self.assertTrue(time.time() - started < 1)
+
+
     def test_for_generator_to_err(self):
         py = create_tmp_test("""
 import sys
@@ -1157,6 +1738,206 @@ else:
         self.assertEqual(len(output), 100)
 
 
+    def test_maxbytes(self):
+        from sh import cat
+
+        data = "".join("%04d\n" % i for i in range(1000))
+
+        p = cat(_in=data, _out_maxbytes=100, _tty_out=False)
+        self.assertEqual(p.stdout, data[-100:].encode())
+
+        p = cat(_in=data, _out_maxbytes=100, _maxbytes_drop="newest",
+            _tty_out=False)
+        self.assertEqual(p.stdout, data[:100].encode())
+
+        # both limits at once, with chunks that are partly pushed off
+        p = cat(_in=data, _out_maxbytes=12, _internal_bufsize=2,
+            _tty_out=False)
+        self.assertEqual(p.stdout, data[-10:].encode())
+        p = cat(_in=data, _out_maxbytes=7, _internal_bufsize=2,
+            _tty_out=False)
+        self.assertEqual(p.stdout, data[-7:].encode())
+
+        self.assertRaises(ValueError, cat, _in=data, _maxbytes_drop="middle")
+
+
+    def test_spill(self):
+        from sh import cat
+
+        data = "".join("%05d\n" % i for i in range(20000))
+
+        p = cat(_in=data, _out_spill=1000, _tty_out=False)
+        self.assertEqual(len(p.process._stdout), len(data))
+        self.assertTrue(p.process._stdout._file is not None)
+
+        view = p.stdout_view
+        if IS_PY3: self.assertTrue(isinstance(view.obj, mmap.mmap))
+        self.assertEqual(bytes(view[:10]), data[:10].encode())
+        self.assertEqual(p.stdout, data.encode())
+        self.assertEqual(str(p), data)
+
+        # it's read back from the file each time, rather than kept around
+        self.assertTrue(p.process._stdout._value is None)
+
+        # iterating over it reads it back a piece at a time, as it's taken
+        # off of the pipe queue, rather than all at once
+        p = cat(_in=data, _out_spill=1000, _tty_out=False,
+            _pipe_maxbytes=6000)
+        lines = iter(p)
+        self.assertEqual(next(lines), "00000\n")
+        self.assertTrue(p.process._pipe_queue.qsize() <= 1000)
+        self.assertEqual("".join(lines), data[6:])
+
+        # under the limit, it's just kept in memory
+        p = cat(_in="small", _out_spill=1000)
+        self.assertTrue(p.process._stdout._file is None)
+        self.assertEqual(p.stdout, b"small")
+
+        self.assertRaises(TypeError, cat, _in=data, _out_spill=1000,
+            _out_maxbytes=10)
+
+
+    def test_stdout_view(self):
+        from sh import echo
+        p = echo("-n", "testing 123")
+        view = p.stdout_view
+        self.assertTrue(isinstance(view, memoryview))
+        self.assertEqual(view.tobytes(), b"testing 123")
+
+        # still good after the output has been put together
+        self.assertEqual(p.stdout, b"testing 123")
+        self.assertEqual(view.tobytes(), b"testing 123")
+        self.assertEqual(p.stdout_view.tobytes(), b"testing 123")
+
+
+    def test_output_cached(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("out\\n")
+sys.stdout.flush()
+sys.stdin.read()
+sys.stdout.write("put")
+""")
+        from sh import echo
+        import time
+        try: from Queue import Queue
+        except ImportError: from queue import Queue
+
+        # while it's running, we see its output as it comes in
+        stdin = Queue()
+        p = python(py.name, _bg=True, _in=stdin, _tty_out=False)
+        try:
+            deadline = time.time() + 5
+            while not p.process.stdout and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(p.process.stdout, b"out\n")
+        finally:
+            stdin.put(None)
+        self.assertEqual(p.stdout, b"out\nput")
+
+        p = echo("-n", "testing 123")
+        self.assertTrue(p.stdout is p.stdout)
+        self.assertTrue(str(p) is str(p))
+        self.assertEqual(len(p), 11)
+        self.assertEqual(p.upper(), "TESTING 123")
+
+
+    def test_line_buffering_split_characters(self):
+        from sh import StreamBufferer
+
+        # a character split across two reads isn't binary data
+        text = b"\xc3\xbcn\xc3\xafc\xc3\xb6d\xc3\xa9\nlines\n"
+        bufferer = StreamBufferer("utf8", 1)
+        lines = []
+        for i in range(len(text)): lines += bufferer.process(text[i:i + 1])
+        self.assertEqual(bufferer.type, 1)
+        self.assertEqual(lines, [b"\xc3\xbcn\xc3\xafc\xc3\xb6d\xc3\xa9\n",
+            b"lines\n"])
+
+        # but actual binary data is
+        bufferer = StreamBufferer("utf8", 1)
+        bufferer.process(b"\xff\xfe\n")
+        self.assertEqual(bufferer.type, 1024)
+
+        # in encodings where a newline byte may be part of another character,
+        # we still only split on newlines
+        text = b"\n\x01\n\x00a\x00b\x00\n\x00"
+        bufferer = StreamBufferer("utf-16-le", 1)
+        lines = []
+        for i in range(len(text)): lines += bufferer.process(text[i:i + 1])
+        self.assertEqual(lines, [b"\n\x01\n\x00", b"a\x00b\x00\n\x00"])
+
+        py = create_tmp_test("""
+import sys, time
+out = getattr(sys.stdout, "buffer", sys.stdout)
+out.write(b"\\xc3")
+out.flush()
+time.sleep(0.1)
+out.write(b"\\xbc\\nok\\n")
+""")
+        lines = []
+        for line in python(py.name, _iter=True, _tty_out=False,
+                _encoding="utf8"):
+            lines.append(line)
+        self.assertEqual(lines, [b"\xc3\xbc\n".decode("utf8"), "ok\n"])
+
+
+    def test_binary(self):
+        py = create_tmp_test("""
+import sys
+out = getattr(sys.stdout, "buffer", sys.stdout)
+out.write(b"\\xff\\xfe\\nab\\x00" * 1000)
+""")
+        data = b"\xff\xfe\nab\x00" * 1000
+
+        chunks = []
+        def agg(chunk): chunks.append(chunk)
+        python(py.name, _binary=True, _out=agg, _tty_out=False).wait()
+        self.assertTrue(all(isinstance(c, bytes) for c in chunks))
+        self.assertEqual(b"".join(chunks), data)
+        self.assertTrue(len(chunks) < 10)
+
+        p = python(py.name, _binary=True, _tty_out=False)
+        self.assertEqual(p, data)
+        self.assertEqual(len(p), len(data))
+        self.assertTrue(b"ab\x00" in p)
+        self.assertEqual(p.count(b"\n"), 1000)
+
+        chunks = []
+        for chunk in python(py.name, _binary=True, _iter=True,
+                _tty_out=False):
+            self.assertTrue(isinstance(chunk, bytes))
+            chunks.append(chunk)
+        self.assertEqual(b"".join(chunks), data)
+
+        # output that happens to decode still isn't decoded
+        from sh import echo
+        for chunk in echo("hi", _binary=True, _iter=True):
+            self.assertEqual(chunk, b"hi\n")
+
+
+    def test_read_sizes(self):
+        from sh import head, sleep
+
+        # reads get bigger while there's a lot to read
+        p = head("-c", 8 * 1024 ** 2, "/dev/zero", _tty_out=False,
+            _out_bufsize=4096)
+        self.assertEqual(len(p.stdout), 8 * 1024 ** 2)
+        self.assertTrue(p.process._stdout_stream.read_size > 4096)
+
+        # binary output goes through a plain pipe, unless we ask for a tty
+        p = head("-c", 10, "/dev/zero", _binary=True)
+        self.assertFalse(p.process.call_args["tty_out"])
+        p = head("-c", 10, "/dev/zero", _binary=True, _tty_out=True)
+        self.assertTrue(p.process.call_args["tty_out"])
+
+        if not IS_OSX:
+            p = sleep(5, _bg=True, _tty_out=False, _pipe_size=256 * 1024)
+            try: size = fcntl.fcntl(p.process._stdout_fd, 1032)
+            finally: p.kill()
+            self.assertEqual(size, 256 * 1024)
+
+
     def test_change_stdout_buffering(self):
         py = create_tmp_test("""
 import sys
@@ -1230,6 +2011,97 @@ sys.stdin.read(1)
         self.assertTrue(abs(elapsed - timeout) < 0.5)
 
 
+    def test_wait_timeout(self):
+        from time import time
+
+        p = sh.sleep(1, _bg=True)
+
+        started = time()
+        self.assertRaises(sh.TimeoutException, p.wait, timeout=0.2)
+        self.assertTrue(time() - started < 0.5)
+
+        # the process keeps on running, and we can still wait on it normally
+        p.wait()
+        self.assertEqual(p.exit_code, 0)
+        self.assertTrue(p.rusage is not None)
+
+
+    @requires_asyncio
+    def test_async(self):
+        # async/await is a syntax error on python 2, so the test lives in a
+        # script of its own
+        py = create_tmp_test("""
+import asyncio
+import sys
+sys.path.insert(0, %r)
+import sh
+
+async def main():
+    out = await sh.echo("testing", _async=True)
+    print(out.strip())
+
+    try: await sh.ls("/aofwje/garogjao4a/eoan3on", _async=True)
+    except sh.ErrorReturnCode: print("error")
+
+    total = 0
+    async for line in sh.seq(1, 100, _async=True, _iter=True):
+        total += int(line)
+    print(total)
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main())
+""" % THIS_DIR)
+
+        out = python(py.name)
+        self.assertEqual(out, "testing\nerror\n5050\n")
+
+
+    @skipUnless(hasattr(os, "posix_spawn"), "Requires posix_spawn")
+    def test_posix_spawn(self):
+        py = create_tmp_test("""
+import os
+import sys
+sys.stdout.write(str(os.getsid(0) == os.getpid()))
+sys.stderr.write("err")
+""")
+
+        # without a tty or a cwd to set up, we shouldn't be forking at all
+        real_fork = os.fork
+        def fork(): raise RuntimeError("forked")
+        os.fork = fork
+        try:
+            p = python(py.name, _tty_out=False)
+            self.assertEqual(p, "True")
+            self.assertEqual(p.stderr, b"err")
+
+            self.assertRaises(RuntimeError, python, py.name, _tty_out=False,
+                _cwd="/")
+        finally:
+            os.fork = real_fork
+
+
+    def test_pass_fds(self):
+        passed_read, passed_write = os.pipe()
+        other_read, other_write = os.pipe()
+
+        py = create_tmp_test("""
+import os
+import sys
+
+os.write(%d, "passed".encode())
+try: os.fstat(%d)
+except OSError: sys.stdout.write("closed")
+""" % (passed_write, other_write))
+
+        try:
+            out = python(py.name, _pass_fds=[passed_write])
+            self.assertEqual(out, "closed")
+            self.assertEqual(os.read(passed_read, 100), b"passed")
+        finally:
+            for fd in (passed_read, passed_write, other_read, other_write):
+                os.close(fd)
+
+
     def test_binary_pipe(self):
         binary = b'\xec;\xedr\xdbF\x92\xf9\x8d\xa7\x98\x02/\x15\xd2K\xc3\x94d\xc9'
 
@@ -1312,18 +2184,18 @@ sys.stderr.write("stderr")
         p = python(py.name, _no_out=True)
         self.assertEqual(p.stdout, b"")
         self.assertEqual(p.stderr, b"stderr")
-        self.assertTrue(p.process._pipe_queue.empty())
+        self.assertTrue(p.process._subscribe_pipe().empty())
 
         def callback(line): pass
         p = python(py.name, _out=callback)
         self.assertEqual(p.stdout, b"")
         self.assertEqual(p.stderr, b"stderr")
-        self.assertTrue(p.process._pipe_queue.empty())
+        self.assertTrue(p.process._subscribe_pipe().empty())
 
         p = python(py.name)
         self.assertEqual(p.stdout, b"stdout")
         self.assertEqual(p.stderr, b"stderr")
-        self.assertFalse(p.process._pipe_queue.empty())
+        self.assertFalse(p.process._subscribe_pipe().empty())
 
 
     def test_no_err(self):
@@ -1335,32 +2207,34 @@ sys.stderr.write("stderr")
         p = python(py.name, _no_err=True)
         self.assertEqual(p.stderr, b"")
         self.assertEqual(p.stdout, b"stdout")
-        self.assertFalse(p.process._pipe_queue.empty())
+        self.assertFalse(p.process._subscribe_pipe().empty())
 
         def callback(line): pass
         p = python(py.name, _err=callback)
         self.assertEqual(p.stderr, b"")
         self.assertEqual(p.stdout, b"stdout")
-        self.assertFalse(p.process._pipe_queue.empty())
+        self.assertFalse(p.process._subscribe_pipe().empty())
 
         p = python(py.name)
         self.assertEqual(p.stderr, b"stderr")
         self.assertEqual(p.stdout, b"stdout")
-        self.assertFalse(p.process._pipe_queue.empty())
+        self.assertFalse(p.process._subscribe_pipe().empty())
 
 
     def test_no_pipe(self):
         from sh import ls
 
+        # nothing has subscribed to our output, so it's only captured
         p = ls()
-        self.assertFalse(p.process._pipe_queue.empty())
+        self.assertEqual(p.process._pipe_queue, None)
+        self.assertFalse(p.process._subscribe_pipe().empty())
 
         def callback(line): pass
         p = ls(_out=callback)
-        self.assertTrue(p.process._pipe_queue.empty())
+        self.assertTrue(p.process._subscribe_pipe().empty())
 
         p = ls(_no_pipe=True)
-        self.assertTrue(p.process._pipe_queue.empty())
+        self.assertTrue(p.process._subscribe_pipe().empty())
 
 
     def test_decode_error_handling(self):
@@ -1474,6 +2348,32 @@ for i in range(10):
         file_obj.close()
 
 
+    def test_shared_reactor_threads(self):
+        import threading
+        from sh import sleep
+
+        before = threading.active_count()
+        procs = [sleep(1, _bg=True) for i in range(50)]
+
+        # every process's io is done by the same reactor thread, so we
+        # shouldn't be any more than one thread up
+        self.assertTrue(threading.active_count() <= before + 1)
+        for p in procs: p.wait()
+
+
+    def test_command_in_callback(self):
+        from sh import echo
+
+        # running another command from a callback, and waiting on it, must
+        # not deadlock.  the callback holds up its own stream while it waits,
+        # but the inner command's io still gets done
+        out = []
+        def agg(line): out.append(str(echo("inner " + line.strip())).strip())
+
+        echo("outer", _out=agg).wait()
+        self.assertEqual(out, ["inner outer"])
+
+
 
 if __name__ == "__main__":
     if len(sys.argv) > 1: